@@ -0,0 +1,56 @@
+"""Add denormalized users.task_count.
+
+Revision ID: a7b8c9d0e1f2
+Revises: f6a7b8c9d0e1
+Create Date: 2026-10-15
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a7b8c9d0e1f2"
+down_revision: Union[str, Sequence[str], None] = "f6a7b8c9d0e1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+
+    op.add_column(
+        "users",
+        sa.Column(
+            "task_count",
+            sa.Integer(),
+            nullable=False,
+            server_default=sa.text("0"),
+        ),
+    )
+
+    # Backfill from existing tasks
+    op.execute(
+        sa.text(
+            "UPDATE users SET task_count = ("
+            "SELECT COUNT(*) FROM generation_tasks "
+            "WHERE generation_tasks.user_id = users.id"
+            ")"
+        )
+    )
+
+    op.create_index(
+        "ix_users_task_count",
+        "users",
+        [sa.text("task_count DESC")],
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+
+    op.drop_index("ix_users_task_count", table_name="users")
+    op.drop_column("users", "task_count")
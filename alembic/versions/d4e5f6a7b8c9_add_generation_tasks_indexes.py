@@ -0,0 +1,60 @@
+"""Add composite indexes on generation_tasks.
+
+Revision ID: d4e5f6a7b8c9
+Revises: c8f1a2d3e4f5
+Create Date: 2026-10-15
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d4e5f6a7b8c9"
+down_revision: Union[str, Sequence[str], None] = "c8f1a2d3e4f5"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block,
+    # so build the indexes outside Alembic's migration transaction to
+    # avoid locking generation_tasks against writes.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_generation_tasks_user_created",
+            "generation_tasks",
+            ["user_id", sa.text("created_at DESC")],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_generation_tasks_status_created",
+            "generation_tasks",
+            ["status", "created_at"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_generation_tasks_status_created",
+            table_name="generation_tasks",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+        op.drop_index(
+            "ix_generation_tasks_user_created",
+            table_name="generation_tasks",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
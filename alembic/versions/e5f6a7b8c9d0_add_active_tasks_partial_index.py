@@ -0,0 +1,48 @@
+"""Add partial index on in-flight generation tasks.
+
+Revision ID: e5f6a7b8c9d0
+Revises: d4e5f6a7b8c9
+Create Date: 2026-10-15
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e5f6a7b8c9d0"
+down_revision: Union[str, Sequence[str], None] = "d4e5f6a7b8c9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+
+    # Most rows end up done/failed; indexing only pending/processing keeps
+    # the index bounded by queue depth.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_gen_tasks_active",
+            "generation_tasks",
+            ["status", "created_at"],
+            postgresql_where=sa.text("status IN ('pending', 'processing')"),
+            postgresql_include=["tokens_spent"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_gen_tasks_active",
+            table_name="generation_tasks",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
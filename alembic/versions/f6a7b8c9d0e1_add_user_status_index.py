@@ -0,0 +1,43 @@
+"""Add (user_id, status) index on generation_tasks.
+
+Revision ID: f6a7b8c9d0e1
+Revises: e5f6a7b8c9d0
+Create Date: 2026-10-15
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f6a7b8c9d0e1"
+down_revision: Union[str, Sequence[str], None] = "e5f6a7b8c9d0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_generation_tasks_user_status",
+            "generation_tasks",
+            ["user_id", "status"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_generation_tasks_user_status",
+            table_name="generation_tasks",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
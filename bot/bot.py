@@ -1,12 +1,15 @@
 """Aiogram Bot and Dispatcher initialization."""
 
 import logging
+from functools import lru_cache
 from typing import Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
+from redis.asyncio import ConnectionPool, Redis
 
 from bot.config import config
 
@@ -17,6 +20,35 @@ _bot: Optional[Bot] = None
 _dp: Optional[Dispatcher] = None
 
 
+@lru_cache(maxsize=1)
+def get_redis_pool() -> ConnectionPool:
+    """
+    Get the shared async Redis connection pool.
+
+    FSM storage, the user cache and other async Redis users share this pool
+    instead of each opening their own sockets.
+    """
+    return ConnectionPool.from_url(config.redis_url, max_connections=50)
+
+
+async def close_redis_pool() -> None:
+    """Disconnect the shared Redis pool."""
+    if get_redis_pool.cache_info().currsize:
+        await get_redis_pool().disconnect()
+        get_redis_pool.cache_clear()
+
+
+def _create_session() -> AiohttpSession:
+    """
+    Create a pooled HTTP session for Telegram API calls.
+
+    The underlying aiohttp ClientSession is created lazily on the first
+    request (inside the running loop) and reused afterwards, so sends
+    share keep-alive connections instead of paying a TLS handshake each.
+    """
+    return AiohttpSession(limit=100, timeout=config.telegram_request_timeout)
+
+
 def get_bot() -> Bot:
     """Get or create the Bot instance."""
     global _bot
@@ -25,6 +57,7 @@ def get_bot() -> Bot:
             raise ValueError("BOT_TOKEN is not configured")
         _bot = Bot(
             token=config.bot_token,
+            session=_create_session(),
             default=DefaultBotProperties(parse_mode=ParseMode.HTML),
         )
         logger.info("Bot instance created")
@@ -36,9 +69,15 @@ def get_dispatcher() -> Dispatcher:
     global _dp
     if _dp is None:
         if config.use_redis_fsm_storage:
+            import orjson
             from aiogram.fsm.storage.redis import RedisStorage
 
-            storage = RedisStorage.from_url(config.redis_url)
+            # orjson returns bytes, which redis accepts as a value as is
+            storage = RedisStorage(
+                redis=Redis(connection_pool=get_redis_pool()),
+                json_loads=orjson.loads,
+                json_dumps=orjson.dumps,
+            )
             _dp = Dispatcher(storage=storage)
             logger.info("Dispatcher created with RedisStorage")
         else:
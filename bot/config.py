@@ -1,22 +1,35 @@
 """Application configuration loaded from environment variables."""
 
 import os
-from dataclasses import dataclass, field
-from typing import List
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import FrozenSet, List
 from dotenv import load_dotenv
 
-load_dotenv()
+# Containers get their environment from the orchestrator; skip the .env
+# file search there.
+if not os.getenv("SKIP_DOTENV"):
+    load_dotenv()
+
+
+_BOOL_MAP = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "y": True,
+    "on": True,
+    "0": False,
+    "false": False,
+    "no": False,
+    "n": False,
+    "off": False,
+}
 
 
 def _parse_bool(value: str, default: bool = False) -> bool:
     if value is None:
         return default
-    value = value.strip().lower()
-    if value in {"1", "true", "yes", "y", "on"}:
-        return True
-    if value in {"0", "false", "no", "n", "off"}:
-        return False
-    return default
+    return _BOOL_MAP.get(value.strip().lower(), default)
 
 
 def _parse_int_list(value: str) -> List[int]:
@@ -29,7 +42,23 @@ def _parse_int_list(value: str) -> List[int]:
         return []
 
 
-@dataclass
+def _env_int(name: str, default: int) -> int:
+    """Read an int env var, falling back to default if unset or malformed."""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a float env var, falling back to default if unset or malformed."""
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+@dataclass(slots=True, frozen=True)
 class Config:
     """Application configuration."""
     
@@ -45,6 +74,8 @@ class Config:
     
     # OpenAI
     openai_api_key: str
+    openai_timeout_seconds: float
+    openai_requests_per_minute: int  # 0 = no throttling
     
     # App settings
     initial_tokens: int
@@ -60,13 +91,14 @@ class Config:
 
     webhook_secret_token: str
     use_redis_fsm_storage: bool
+    use_redis_user_cache: bool
 
     # Generation settings
     high_cost_threshold: int  # Порог для двойного подтверждения
     max_tasks_per_user_per_hour: int  # Rate limiting
 
     # Admin settings
-    admin_ids: List[int] = field(default_factory=list)  # Telegram IDs админов
+    admin_ids: FrozenSet[int] = frozenset()  # Telegram IDs админов
     admin_api_key: str = ""  # API ключ для HTTP админ-эндпоинтов
 
     def is_admin(self, telegram_id: int) -> bool:
@@ -74,22 +106,25 @@ class Config:
         return telegram_id in self.admin_ids
 
 
+@lru_cache(maxsize=1)
 def load_config() -> Config:
-    """Load configuration from environment variables."""
+    """Load configuration from environment variables (parsed once per process)."""
     return Config(
         bot_token=os.getenv("BOT_TOKEN", ""),
         webhook_url=os.getenv("WEBHOOK_URL", ""),
         database_url=os.getenv("DATABASE_URL", ""),
         redis_url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
         openai_api_key=os.getenv("OPENAI_API_KEY", ""),
-        initial_tokens=int(os.getenv("INITIAL_TOKENS", "10")),
+        openai_timeout_seconds=_env_float("OPENAI_TIMEOUT_SECONDS", 180),
+        openai_requests_per_minute=_env_int("OPENAI_REQUESTS_PER_MINUTE", 0),
+        initial_tokens=_env_int("INITIAL_TOKENS", 10),
 
         log_level=os.getenv("LOG_LEVEL", "INFO"),
 
-        telegram_request_timeout=float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", "60")),
-        webhook_max_retries=int(os.getenv("WEBHOOK_MAX_RETRIES", "5")),
-        webhook_retry_delay_seconds=float(os.getenv("WEBHOOK_RETRY_DELAY_SECONDS", "2")),
-        webhook_retry_backoff=float(os.getenv("WEBHOOK_RETRY_BACKOFF", "2")),
+        telegram_request_timeout=_env_float("TELEGRAM_REQUEST_TIMEOUT", 60),
+        webhook_max_retries=_env_int("WEBHOOK_MAX_RETRIES", 5),
+        webhook_retry_delay_seconds=_env_float("WEBHOOK_RETRY_DELAY_SECONDS", 2),
+        webhook_retry_backoff=_env_float("WEBHOOK_RETRY_BACKOFF", 2),
         disable_webhook=_parse_bool(os.getenv("DISABLE_WEBHOOK", "0"), default=False),
         delete_webhook_on_shutdown=_parse_bool(
             os.getenv("DELETE_WEBHOOK_ON_SHUTDOWN", "1"), default=True
@@ -97,13 +132,14 @@ def load_config() -> Config:
 
         webhook_secret_token=os.getenv("WEBHOOK_SECRET_TOKEN", ""),
         use_redis_fsm_storage=_parse_bool(os.getenv("USE_REDIS_FSM_STORAGE", "0"), default=False),
+        use_redis_user_cache=_parse_bool(os.getenv("USE_REDIS_USER_CACHE", "0"), default=False),
 
         # Generation settings
-        high_cost_threshold=int(os.getenv("HIGH_COST_THRESHOLD", "4000")),
-        max_tasks_per_user_per_hour=int(os.getenv("MAX_TASKS_PER_USER_PER_HOUR", "20")),
+        high_cost_threshold=_env_int("HIGH_COST_THRESHOLD", 4000),
+        max_tasks_per_user_per_hour=_env_int("MAX_TASKS_PER_USER_PER_HOUR", 20),
 
         # Admin settings
-        admin_ids=_parse_int_list(os.getenv("ADMIN_IDS", "")),
+        admin_ids=frozenset(_parse_int_list(os.getenv("ADMIN_IDS", ""))),
         admin_api_key=os.getenv("ADMIN_API_KEY", ""),
     )
 
@@ -1,9 +1,13 @@
 """Async SQLAlchemy database configuration."""
 
+import asyncio
 from typing import Optional
 
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine, AsyncEngine
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from bot.config import config
 
@@ -24,10 +28,33 @@ def get_engine() -> AsyncEngine:
     if _engine is None:
         if not config.database_url:
             raise ValueError("DATABASE_URL is not configured")
+
+        engine_kwargs = {}
+        if make_url(config.database_url).get_driver_name() == "asyncpg":
+            engine_kwargs = {
+                # Explicit so a sync QueuePool can never end up under asyncio
+                "poolclass": AsyncAdaptedQueuePool,
+                # Sized for bursts of concurrent updates/callbacks
+                "pool_size": 20,
+                "max_overflow": 40,
+                # Reuse the most recently returned (warm) connection first so
+                # idle extras can age out via pool_recycle after a burst
+                "pool_use_lifo": True,
+                "connect_args": {
+                    # Cache parsed/planned statements per connection
+                    "statement_cache_size": 1024,
+                    "prepared_statement_cache_size": 1024,
+                    # JIT only adds latency to short OLTP queries
+                    "server_settings": {"jit": "off"},
+                },
+            }
+
         _engine = create_async_engine(
             config.database_url,
             echo=False,
             pool_pre_ping=True,
+            pool_recycle=1800,
+            **engine_kwargs,
         )
     return _engine
 
@@ -69,6 +96,26 @@ async def init_db() -> None:
         await conn.run_sync(Base.metadata.create_all)
 
 
+async def warm_pool() -> None:
+    """Open pool_size connections up front.
+
+    Keeps the connect/auth handshake out of the first updates after startup.
+    Pools without a fixed size (e.g. in-memory SQLite) are left alone.
+    """
+    engine = get_engine()
+    if not isinstance(engine.pool, AsyncAdaptedQueuePool):
+        return
+
+    # Hold all of them at once, otherwise each checkout reuses the previous one
+    conns = await asyncio.gather(
+        *(engine.connect().start() for _ in range(engine.pool.size()))
+    )
+    try:
+        await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in conns))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in conns))
+
+
 async def close_db() -> None:
     """Close database connections."""
     global _engine, _async_session_maker
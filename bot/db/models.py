@@ -3,7 +3,7 @@
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
@@ -31,6 +31,11 @@ class User(Base):
     image_size: Mapped[str] = mapped_column(
         String(20), default="1024x1024", nullable=False
     )
+    # Denormalized number of generation tasks, kept in sync by
+    # TaskRepository so top-user ranking is an indexed ORDER BY
+    task_count: Mapped[int] = mapped_column(
+        Integer, default=0, server_default=text("0"), nullable=False
+    )
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
@@ -43,6 +48,10 @@ class User(Base):
         "GenerationTask", back_populates="user", lazy="selectin"
     )
 
+    __table_args__ = (
+        Index("ix_users_task_count", task_count.desc()),
+    )
+
 
 class GenerationTask(Base):
     """Generation task model for image generation/editing requests."""
@@ -91,6 +100,27 @@ class GenerationTask(Base):
     # Relationships
     user: Mapped["User"] = relationship("User", back_populates="tasks")
 
+    __table_args__ = (
+        # History and rate-limit lookups: WHERE user_id = ? ORDER BY created_at DESC
+        Index(
+            "ix_generation_tasks_user_created",
+            "user_id",
+            created_at.desc(),
+        ),
+        # Per-user status counts (/userinfo)
+        Index("ix_generation_tasks_user_status", "user_id", "status"),
+        # Admin stats: per-status counts and "today" windows
+        Index("ix_generation_tasks_status_created", "status", "created_at"),
+        # Queue scans: only in-flight tasks, so the index stays tiny
+        Index(
+            "ix_gen_tasks_active",
+            "status",
+            "created_at",
+            postgresql_where=text("status IN ('pending', 'processing')"),
+            postgresql_include=["tokens_spent"],
+        ),
+    )
+
 
 class Template(Base):
     """Template model for predefined prompt templates."""
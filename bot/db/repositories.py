@@ -1,16 +1,141 @@
 """Repository classes for database CRUD operations."""
 
-from datetime import datetime, timedelta
-from typing import Optional, List
+from collections import Counter
+from datetime import timedelta
+from typing import NamedTuple, Optional, List
 
-from sqlalchemy import select, desc, func
+from sqlalchemy import JSON, DateTime, Row, and_, bindparam, case, insert, or_, select, update, desc, func, true
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
 from bot.config import config
 from bot.db.models import User, GenerationTask
+from bot.db.user_cache import UserSnapshot, cache_user, get_cached_user, invalidate_user
 from bot.services.image_tokens import estimate_image_tokens
 
 
+class TopUser(NamedTuple):
+    """Row returned by StatsRepository.get_top_users."""
+
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    task_count: int
+
+
+class HistoryPage(NamedTuple):
+    """Result of TaskRepository.get_user_history_page."""
+
+    tasks: List[GenerationTask]
+    total: int
+    done: int
+
+
+# Time cutoffs and JSON aggregates are computed by the DB. Postgres gets
+# its native functions; SQLite (the test database) gets equivalents, so the
+# same statements run in tests.
+class _utc_today_start(FunctionElement):
+    """Midnight UTC of the current day."""
+
+    type = DateTime(timezone=True)
+    inherit_cache = True
+
+
+@compiles(_utc_today_start)
+def _utc_today_start_pg(element, compiler, **kw):
+    return "timezone('UTC', date_trunc('day', timezone('UTC', now())))"
+
+
+@compiles(_utc_today_start, "sqlite")
+def _utc_today_start_sqlite(element, compiler, **kw):
+    return "datetime('now', 'start of day')"
+
+
+class _hours_ago(FunctionElement):
+    """Current time minus the given number of hours."""
+
+    type = DateTime(timezone=True)
+    inherit_cache = True
+
+
+@compiles(_hours_ago)
+def _hours_ago_pg(element, compiler, **kw):
+    return "now() - make_interval(0, 0, 0, 0, %s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(_hours_ago, "sqlite")
+def _hours_ago_sqlite(element, compiler, **kw):
+    return "datetime('now', '-' || %s || ' hours')" % compiler.process(element.clauses, **kw)
+
+
+class _json_object_agg(FunctionElement):
+    """Aggregate (key, value) rows into one JSON object."""
+
+    type = JSON()
+    inherit_cache = True
+
+
+@compiles(_json_object_agg)
+def _json_object_agg_pg(element, compiler, **kw):
+    return "jsonb_object_agg(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(_json_object_agg, "sqlite")
+def _json_object_agg_sqlite(element, compiler, **kw):
+    return "json_group_object(%s)" % compiler.process(element.clauses, **kw)
+
+
+# Hot-path statements are built once at import; per-call values are passed
+# as bound parameters, so each call skips statement construction and
+# cache-key generation.
+_GET_USER_BY_TELEGRAM_ID = select(User).where(
+    User.telegram_id == bindparam("telegram_id")
+)
+_GET_USER_SETTINGS = select(
+    User.id,
+    User.tokens,
+    User.image_quality,
+    User.image_size,
+    User.selected_model,
+).where(User.telegram_id == bindparam("telegram_id"))
+_GET_USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+_GET_TASK_BY_ID = select(GenerationTask).where(
+    GenerationTask.id == bindparam("task_id")
+)
+_GET_USER_HISTORY = (
+    select(GenerationTask)
+    .where(GenerationTask.user_id == bindparam("user_id"))
+    .order_by(desc(GenerationTask.created_at))
+    .limit(bindparam("limit"))
+)
+_COUNT_USER_TASKS_SINCE = (
+    select(func.count(GenerationTask.id))
+    .where(GenerationTask.user_id == bindparam("user_id"))
+    .where(
+        GenerationTask.created_at
+        >= _hours_ago(bindparam("hours"))
+    )
+)
+_TASK_OWNER_TELEGRAM_ID = (
+    select(User.telegram_id)
+    .where(User.id == GenerationTask.user_id)
+    .scalar_subquery()
+)
+
+
+# Config is frozen, so the starting balance is a constant:
+# INITIAL_TOKENS default generations at medium quality, 1024x1024.
+_INITIAL_USER_TOKENS = config.initial_tokens * estimate_image_tokens("medium", "1024x1024")
+
+_TASK_DEFAULTS = {
+    "model": "gpt-image-1",
+    "image_quality": "medium",
+    "image_size": "1024x1024",
+    "source_image_url": None,
+}
+
+
 class UserRepository:
     """Repository for User CRUD operations."""
     
@@ -20,9 +145,46 @@ class UserRepository:
     async def get_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """Get user by Telegram ID."""
         result = await self.session.execute(
-            select(User).where(User.telegram_id == telegram_id)
+            _GET_USER_BY_TELEGRAM_ID, {"telegram_id": telegram_id}
+        )
+        return result.scalar_one_or_none()
+
+    async def get_settings_tuple(self, telegram_id: int) -> Optional[Row]:
+        """
+        Get (id, tokens, image_quality, image_size, selected_model) as a plain row.
+
+        Used by read-only generation flows that don't need an ORM User.
+        """
+        result = await self.session.execute(
+            _GET_USER_SETTINGS, {"telegram_id": telegram_id}
+        )
+        return result.one_or_none()
+
+    async def get_tokens(self, telegram_id: int) -> Optional[int]:
+        """Get user's token balance without loading the full User row."""
+        result = await self.session.execute(
+            select(User.tokens).where(User.telegram_id == telegram_id)
         )
         return result.scalar_one_or_none()
+
+    async def get_snapshot(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """
+        Get read-only user fields by Telegram ID, served from Redis when cached.
+
+        Use this in handlers that only display or read user settings; writes
+        must go through the update methods, which invalidate the cache.
+        """
+        snapshot = await get_cached_user(telegram_id)
+        if snapshot is not None:
+            return snapshot
+
+        user = await self.get_by_telegram_id(telegram_id)
+        if user is None:
+            return None
+
+        snapshot = UserSnapshot.from_user(user)
+        await cache_user(snapshot)
+        return snapshot
     
     async def get_or_create(
         self,
@@ -41,18 +203,19 @@ class UserRepository:
         if user is not None:
             return user, False
         
-        default_image_tokens = estimate_image_tokens("medium", "1024x1024")
-
         # Create new user with initial tokens
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            first_name=first_name,
-            tokens=config.initial_tokens * default_image_tokens,
+        result = await self.session.execute(
+            insert(User)
+            .values(
+                telegram_id=telegram_id,
+                username=username,
+                first_name=first_name,
+                tokens=_INITIAL_USER_TOKENS,
+            )
+            .returning(User)
         )
-        self.session.add(user)
+        user = result.scalar_one()
         await self.session.commit()
-        await self.session.refresh(user)
         
         return user, True
     
@@ -68,17 +231,17 @@ class UserRepository:
             Updated user or None if not found
         """
         result = await self.session.execute(
-            select(User).where(User.id == user_id)
+            update(User)
+            .where(User.id == user_id)
+            .values(tokens=User.tokens + tokens_delta)
+            .returning(User)
         )
         user = result.scalar_one_or_none()
-        
-        if user is None:
-            return None
-        
-        user.tokens += tokens_delta
         await self.session.commit()
-        await self.session.refresh(user)
-        
+
+        if user is not None:
+            await invalidate_user(user.telegram_id)
+
         return user
     
     async def update_model(self, user_id: int, model: str) -> Optional[User]:
@@ -93,17 +256,17 @@ class UserRepository:
             Updated user or None if not found
         """
         result = await self.session.execute(
-            select(User).where(User.id == user_id)
+            update(User)
+            .where(User.id == user_id)
+            .values(selected_model=model)
+            .returning(User)
         )
         user = result.scalar_one_or_none()
-        
-        if user is None:
-            return None
-        
-        user.selected_model = model
         await self.session.commit()
-        await self.session.refresh(user)
-        
+
+        if user is not None:
+            await invalidate_user(user.telegram_id)
+
         return user
 
     async def update_image_settings(
@@ -114,22 +277,29 @@ class UserRepository:
     ) -> Optional[User]:
         """Update user's image generation settings."""
 
-        result = await self.session.execute(
-            select(User).where(User.id == user_id)
-        )
-        user = result.scalar_one_or_none()
-
-        if user is None:
-            return None
-
+        values = {}
         if image_quality is not None:
-            user.image_quality = image_quality
-
+            values["image_quality"] = image_quality
         if image_size is not None:
-            user.image_size = image_size
+            values["image_size"] = image_size
 
+        if not values:
+            result = await self.session.execute(
+                _GET_USER_BY_ID, {"user_id": user_id}
+            )
+            return result.scalar_one_or_none()
+
+        result = await self.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(**values)
+            .returning(User)
+        )
+        user = result.scalar_one_or_none()
         await self.session.commit()
-        await self.session.refresh(user)
+
+        if user is not None:
+            await invalidate_user(user.telegram_id)
 
         return user
 
@@ -150,6 +320,7 @@ class TaskRepository:
         image_quality: str = "medium",
         image_size: str = "1024x1024",
         source_image_url: Optional[str] = None,
+        commit: bool = True,
     ) -> GenerationTask:
         """
         Create a new generation task.
@@ -160,26 +331,65 @@ class TaskRepository:
             prompt: Text prompt for generation
             tokens_spent: Number of tokens spent
             source_image_url: Source image URL for edit tasks
+            commit: If False, leave the transaction open for the caller
         
         Returns:
             Created GenerationTask
         """
-        task = GenerationTask(
-            user_id=user_id,
-            task_type=task_type,
-            model=model,
-            image_quality=image_quality,
-            image_size=image_size,
-            prompt=prompt,
-            tokens_spent=tokens_spent,
-            source_image_url=source_image_url,
-            status="pending",
+        tasks = await self.create_many([
+            {
+                "user_id": user_id,
+                "task_type": task_type,
+                "prompt": prompt,
+                "tokens_spent": tokens_spent,
+                "model": model,
+                "image_quality": image_quality,
+                "image_size": image_size,
+                "source_image_url": source_image_url,
+            }
+        ], commit=commit)
+        return tasks[0]
+
+    async def create_many(
+        self,
+        rows: List[dict],
+        commit: bool = True,
+    ) -> List[GenerationTask]:
+        """
+        Create several generation tasks in one INSERT and one commit.
+        
+        Args:
+            rows: Task fields as accepted by create(); omitted optional
+                fields get the same defaults as create()
+            commit: If False, leave the transaction open for the caller
+        
+        Returns:
+            Created tasks, in the same order as rows
+        """
+        if not rows:
+            return []
+        
+        params = [{**_TASK_DEFAULTS, **row, "status": "pending"} for row in rows]
+        result = await self.session.execute(
+            insert(GenerationTask).returning(
+                GenerationTask, sort_by_parameter_order=True
+            ),
+            params,
         )
-        self.session.add(task)
-        await self.session.commit()
-        await self.session.refresh(task)
+        tasks = list(result.scalars().all())
         
-        return task
+        # Keep users.task_count in sync within the same transaction
+        for user_id, count in Counter(row["user_id"] for row in params).items():
+            await self.session.execute(
+                update(User)
+                .where(User.id == user_id)
+                .values(task_count=User.task_count + count)
+            )
+        
+        if commit:
+            await self.session.commit()
+        
+        return tasks
     
     async def update_status(
         self,
@@ -189,6 +399,7 @@ class TaskRepository:
         result_file_id: Optional[str] = None,
         error_message: Optional[str] = None,
         increment_retry: bool = False,
+        expected_status: Optional[str] = None,
     ) -> Optional[GenerationTask]:
         """
         Update task status and related fields.
@@ -199,37 +410,131 @@ class TaskRepository:
             result_image_url: URL of generated image (for "done" status)
             error_message: Error message (for "failed" status)
             increment_retry: Whether to increment retry count
+            expected_status: Only update if the task is currently in this status
         
         Returns:
-            Updated task or None if not found
+            Updated task or None if not found (or not in expected_status)
         """
-        result = await self.session.execute(
-            select(GenerationTask).where(GenerationTask.id == task_id)
-        )
-        task = result.scalar_one_or_none()
-        
-        if task is None:
-            return None
-        
-        task.status = status
+        values = {"status": status}
         
         if result_image_url is not None:
-            task.result_image_url = result_image_url
+            values["result_image_url"] = result_image_url
 
         if result_file_id is not None:
-            task.result_file_id = result_file_id
+            values["result_file_id"] = result_file_id
         
         if error_message is not None:
-            task.error_message = error_message
+            values["error_message"] = error_message
         
         if increment_retry:
-            task.retry_count += 1
+            values["retry_count"] = GenerationTask.retry_count + 1
         
+        stmt = update(GenerationTask).where(GenerationTask.id == task_id)
+        if expected_status is not None:
+            stmt = stmt.where(GenerationTask.status == expected_status)
+        
+        result = await self.session.execute(
+            stmt
+            .values(**values)
+            .returning(GenerationTask)
+        )
+        task = result.scalar_one_or_none()
         await self.session.commit()
-        await self.session.refresh(task)
         
         return task
     
+    async def start_processing(
+        self,
+        task_id: int,
+        stale_after: Optional[timedelta] = None,
+    ) -> Optional[tuple[GenerationTask, Optional[int]]]:
+        """
+        Claim a pending task for processing and load it with its owner's
+        Telegram ID.
+        
+        One UPDATE ... RETURNING guarded by the current status, so of two
+        jobs racing for the same task only one gets it. The Telegram ID
+        comes from a scalar subquery, so it is None (rather than the task
+        missing) if the user row is gone.
+        
+        Args:
+            task_id: Task's database ID
+            stale_after: Also reclaim a task stuck in "processing" for
+                longer than this (its job died without recording a result)
+        
+        Returns:
+            (task, telegram_id) or None if the task is not found or
+            already claimed
+        """
+        claimable = GenerationTask.status == "pending"
+        if stale_after is not None:
+            claimable = or_(
+                claimable,
+                and_(
+                    GenerationTask.status == "processing",
+                    GenerationTask.updated_at < func.now() - stale_after,
+                ),
+            )
+        
+        result = await self.session.execute(
+            update(GenerationTask)
+            .where(GenerationTask.id == task_id, claimable)
+            .values(status="processing")
+            .returning(GenerationTask, _TASK_OWNER_TELEGRAM_ID)
+        )
+        row = result.one_or_none()
+        await self.session.commit()
+        
+        if row is None:
+            return None
+        return row[0], row[1]
+    
+    async def record_failure(
+        self,
+        task_id: int,
+        error_message: str,
+        max_retries: int,
+    ) -> Optional[tuple[GenerationTask, Optional[int]]]:
+        """
+        Count a failed attempt in a single UPDATE ... RETURNING.
+        
+        Increments retry_count and sets status to "failed" once it reaches
+        max_retries, otherwise back to "pending" for the next retry. Only
+        applies to a task in "processing", so a failure can't be counted
+        (and refunded) twice.
+        
+        Args:
+            task_id: Task's database ID
+            error_message: Error from this attempt
+            max_retries: Attempts allowed before the task is failed
+        
+        Returns:
+            (task, owner's telegram_id) or None if not found or not
+            processing
+        """
+        result = await self.session.execute(
+            update(GenerationTask)
+            .where(
+                GenerationTask.id == task_id,
+                GenerationTask.status == "processing",
+            )
+            .values(
+                status=case(
+                    (GenerationTask.retry_count + 1 >= max_retries, "failed"),
+                    else_="pending",
+                ),
+                error_message=error_message,
+                retry_count=GenerationTask.retry_count + 1,
+            )
+            .returning(GenerationTask, _TASK_OWNER_TELEGRAM_ID)
+        )
+        row = result.one_or_none()
+        await self.session.commit()
+        
+        if row is None:
+            return None
+        return row[0], row[1]
+    
     async def get_user_history(
         self,
         user_id: int,
@@ -246,17 +551,55 @@ class TaskRepository:
             List of GenerationTask ordered by created_at descending
         """
         result = await self.session.execute(
-            select(GenerationTask)
+            _GET_USER_HISTORY, {"user_id": user_id, "limit": limit}
+        )
+        return list(result.scalars().all())
+    
+    async def get_user_history_page(
+        self,
+        user_id: int,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> HistoryPage:
+        """
+        Get one page of user's history together with the user's task counts.
+
+        The counts come from COUNT(*) OVER (), so page and counts share a
+        single query.
+
+        Returns:
+            HistoryPage with tasks ordered by created_at descending. The
+            counts are 0 when offset is past the last task.
+        """
+        result = await self.session.execute(
+            select(
+                GenerationTask,
+                func.count().over().label("total"),
+                func.count().filter(GenerationTask.status == "done").over().label("done"),
+            )
             .where(GenerationTask.user_id == user_id)
             .order_by(desc(GenerationTask.created_at))
             .limit(limit)
+            .offset(offset)
         )
-        return list(result.scalars().all())
+        rows = result.all()
+        if not rows:
+            return HistoryPage([], 0, 0)
+        return HistoryPage([row[0] for row in rows], rows[0].total, rows[0].done)
+    
+    async def count_by_status(self, user_id: int) -> dict[str, int]:
+        """Get user's task counts grouped by status."""
+        result = await self.session.execute(
+            select(GenerationTask.status, func.count())
+            .where(GenerationTask.user_id == user_id)
+            .group_by(GenerationTask.status)
+        )
+        return {status: count for status, count in result.all()}
     
     async def get_by_id(self, task_id: int) -> Optional[GenerationTask]:
         """Get task by ID."""
         result = await self.session.execute(
-            select(GenerationTask).where(GenerationTask.id == task_id)
+            _GET_TASK_BY_ID, {"task_id": task_id}
         )
         return result.scalar_one_or_none()
 
@@ -276,11 +619,8 @@ class TaskRepository:
         Returns:
             Number of tasks created in the time period
         """
-        since = datetime.utcnow() - timedelta(hours=hours)
         result = await self.session.execute(
-            select(func.count(GenerationTask.id))
-            .where(GenerationTask.user_id == user_id)
-            .where(GenerationTask.created_at >= since)
+            _COUNT_USER_TASKS_SINCE, {"user_id": user_id, "hours": hours}
         )
         return result.scalar() or 0
 
@@ -324,7 +664,7 @@ class StatsRepository:
     
     async def get_tasks_today(self) -> int:
         """Get number of tasks created today."""
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        today = _utc_today_start()
         result = await self.session.execute(
             select(func.count(GenerationTask.id))
             .where(GenerationTask.created_at >= today)
@@ -333,7 +673,7 @@ class StatsRepository:
     
     async def get_users_today(self) -> int:
         """Get number of users registered today."""
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        today = _utc_today_start()
         result = await self.session.execute(
             select(func.count(User.id))
             .where(User.created_at >= today)
@@ -342,48 +682,117 @@ class StatsRepository:
     
     async def get_active_users_today(self) -> int:
         """Get number of users who created tasks today."""
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        today = _utc_today_start()
         result = await self.session.execute(
             select(func.count(func.distinct(GenerationTask.user_id)))
             .where(GenerationTask.created_at >= today)
         )
         return result.scalar() or 0
     
-    async def get_top_users(self, limit: int = 10) -> List[tuple]:
-        """Get top users by number of tasks."""
+    async def get_top_users(self, limit: int = 10) -> List[TopUser]:
+        """
+        Get top users by number of tasks.
+
+        Reads the denormalized users.task_count, so this is an indexed
+        ORDER BY ... LIMIT rather than an aggregate over all tasks.
+        """
         result = await self.session.execute(
             select(
                 User.telegram_id,
                 User.username,
                 User.first_name,
-                func.count(GenerationTask.id).label("task_count")
+                User.task_count,
             )
-            .join(GenerationTask, User.id == GenerationTask.user_id)
-            .group_by(User.id)
-            .order_by(desc("task_count"))
+            .where(User.task_count > 0)
+            .order_by(User.task_count.desc())
             .limit(limit)
         )
-        return result.all()
+        return [TopUser(*row) for row in result.all()]
     
     async def get_model_usage(self) -> dict:
-        """Get task counts grouped by model."""
+        """Get task counts grouped by model, most used first."""
+        count = func.count(GenerationTask.id)
         result = await self.session.execute(
-            select(
-                GenerationTask.model,
-                func.count(GenerationTask.id)
-            ).group_by(GenerationTask.model)
+            select(GenerationTask.model, count)
+            .group_by(GenerationTask.model)
+            .order_by(count.desc())
         )
         return {row[0]: row[1] for row in result.all()}
     
     async def get_full_stats(self) -> dict:
-        """Get comprehensive statistics."""
+        """
+        Get comprehensive statistics in a single round-trip.
+
+        Task aggregates are computed in one pass over generation_tasks using
+        FILTER clauses, and the per-status/per-model breakdowns come back as
+        JSON objects, so the whole result is a single row.
+        """
+        today = _utc_today_start()
+
+        user_totals = select(
+            func.count(User.id).label("total_users"),
+            func.count(User.id)
+            .filter(User.created_at >= today)
+            .label("users_today"),
+        ).subquery()
+
+        task_totals = select(
+            func.count(GenerationTask.id).label("total_tasks"),
+            func.sum(GenerationTask.tokens_spent).label("total_tokens_spent"),
+            func.count(GenerationTask.id)
+            .filter(GenerationTask.created_at >= today)
+            .label("tasks_today"),
+            func.count(func.distinct(GenerationTask.user_id))
+            .filter(GenerationTask.created_at >= today)
+            .label("active_users_today"),
+        ).subquery()
+
+        by_status = (
+            select(
+                GenerationTask.status.label("key"),
+                func.count(GenerationTask.id).label("cnt"),
+            )
+            .group_by(GenerationTask.status)
+            .subquery()
+        )
+        by_model = (
+            select(
+                GenerationTask.model.label("key"),
+                func.count(GenerationTask.id).label("cnt"),
+            )
+            .group_by(GenerationTask.model)
+            .subquery()
+        )
+
+        result = await self.session.execute(
+            select(
+                user_totals.c.total_users,
+                user_totals.c.users_today,
+                task_totals.c.total_tasks,
+                task_totals.c.total_tokens_spent,
+                task_totals.c.tasks_today,
+                task_totals.c.active_users_today,
+                select(
+                    _json_object_agg(by_status.c.key, by_status.c.cnt)
+                )
+                .scalar_subquery()
+                .label("tasks_by_status"),
+                select(
+                    _json_object_agg(by_model.c.key, by_model.c.cnt)
+                )
+                .scalar_subquery()
+                .label("model_usage"),
+            ).select_from(user_totals.join(task_totals, true()))
+        )
+        row = result.one()
+
         return {
-            "total_users": await self.get_total_users(),
-            "total_tasks": await self.get_total_tasks(),
-            "tasks_by_status": await self.get_tasks_by_status(),
-            "total_tokens_spent": await self.get_total_tokens_spent(),
-            "tasks_today": await self.get_tasks_today(),
-            "users_today": await self.get_users_today(),
-            "active_users_today": await self.get_active_users_today(),
-            "model_usage": await self.get_model_usage(),
+            "total_users": row.total_users or 0,
+            "total_tasks": row.total_tasks or 0,
+            "tasks_by_status": row.tasks_by_status or {},
+            "total_tokens_spent": row.total_tokens_spent or 0,
+            "tasks_today": row.tasks_today or 0,
+            "users_today": row.users_today or 0,
+            "active_users_today": row.active_users_today or 0,
+            "model_usage": row.model_usage or {},
         }
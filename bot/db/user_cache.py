@@ -0,0 +1,104 @@
+"""Redis-backed cache of hot user fields keyed by Telegram ID."""
+
+import json
+import logging
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from bot.bot import get_redis_pool
+from bot.config import config
+from bot.db.models import User
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_TTL_SECONDS = 60
+
+_redis: Optional[Redis] = None
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Read-only copy of the user fields handlers need on every update."""
+
+    id: int
+    telegram_id: int
+    tokens: int
+    selected_model: str
+    image_quality: str
+    image_size: str
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            telegram_id=user.telegram_id,
+            tokens=user.tokens,
+            selected_model=user.selected_model,
+            image_quality=user.image_quality,
+            image_size=user.image_size,
+        )
+
+
+def _get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis(connection_pool=get_redis_pool())
+    return _redis
+
+
+def _key(telegram_id: int) -> str:
+    return f"u:{telegram_id}"
+
+
+async def get_cached_user(telegram_id: int) -> Optional[UserSnapshot]:
+    """Return cached snapshot or None on miss (or if the cache is disabled)."""
+    if not config.use_redis_user_cache:
+        return None
+
+    try:
+        raw = await _get_redis().get(_key(telegram_id))
+    except RedisError as e:
+        logger.warning(f"User cache read failed for {telegram_id}: {e}")
+        return None
+
+    if raw is None:
+        return None
+
+    return UserSnapshot(**json.loads(raw))
+
+
+async def cache_user(snapshot: UserSnapshot) -> None:
+    """Store snapshot with a short TTL."""
+    if not config.use_redis_user_cache:
+        return
+
+    try:
+        await _get_redis().set(
+            _key(snapshot.telegram_id),
+            json.dumps(asdict(snapshot), separators=(",", ":")),
+            ex=USER_CACHE_TTL_SECONDS,
+        )
+    except RedisError as e:
+        logger.warning(f"User cache write failed for {snapshot.telegram_id}: {e}")
+
+
+async def invalidate_user(telegram_id: int) -> None:
+    """Drop cached snapshot after any write to the user row."""
+    if not config.use_redis_user_cache:
+        return
+
+    try:
+        await _get_redis().delete(_key(telegram_id))
+    except RedisError as e:
+        logger.warning(f"User cache invalidation failed for {telegram_id}: {e}")
+
+
+async def close_user_cache() -> None:
+    """Release the user cache client (the shared pool is closed separately)."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -0,0 +1,25 @@
+"""Helpers shared by the generate, edit and template handlers."""
+
+from typing import Optional
+
+from aiogram.types import CallbackQuery
+
+
+async def answer_if_unchanged(
+    callback: CallbackQuery,
+    value: str,
+    current: Optional[str],
+) -> bool:
+    """
+    Answer a settings tap on the already selected option.
+    
+    Re-rendering would produce identical text, which Telegram rejects as
+    "message is not modified", so the tap is only acknowledged.
+    
+    Returns:
+        True if the tap was answered and the handler should stop
+    """
+    if value != current:
+        return False
+    await callback.answer()
+    return True
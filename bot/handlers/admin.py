@@ -7,10 +7,15 @@ Commands:
 - /addtokens <user_id> <amount> - Add tokens to user
 """
 
+import asyncio
 import logging
+import time
+from collections import defaultdict
 from datetime import datetime
+from typing import Any, Awaitable, Callable
 
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
@@ -18,21 +23,46 @@ from aiogram.types import InlineKeyboardButton
 
 from bot.config import config
 from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, StatsRepository
+from bot.db.repositories import UserRepository, StatsRepository, TaskRepository
 
 logger = logging.getLogger(__name__)
 
 router = Router(name="admin")
 
+# Only admins reach any handler in this router; updates from other users
+# skip it and are answered by denied_router below.
+router.message.filter(F.from_user.id.in_(config.admin_ids))
+router.callback_query.filter(F.from_user.id.in_(config.admin_ids))
 
-def admin_required(func):
-    """Decorator to check if user is admin."""
-    async def wrapper(message: Message, *args, **kwargs):
-        if not config.is_admin(message.from_user.id):
-            await message.answer("❌ У вас нет доступа к этой команде.")
-            return
-        return await func(message, *args, **kwargs)
-    return wrapper
+# Registered right after router: refuses admin commands and buttons for
+# everyone else, so they don't fall through to the other routers (e.g. be
+# taken as an image prompt in the middle of the generation flow).
+denied_router = Router(name="admin_denied")
+
+# Short-lived cache for admin stats so refresh bursts share one DB query.
+# Keyed by stats kind; values are (monotonic timestamp, data).
+_STATS_TTL = 30
+_STATS_CACHE: dict[str, tuple[float, Any]] = {}
+# One lock per stats kind: on a miss only one coroutine hits the DB,
+# concurrent callers wait and reuse its result.
+_STATS_LOCKS: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Minimum interval between refresh clicks per admin. Only admins reach
+# the refresh handler, so the dict is bounded by len(admin_ids).
+_REFRESH_MIN_INTERVAL = 5
+_LAST_REFRESH: dict[int, float] = {}
+
+
+@denied_router.message(Command("admin", "stats", "addtokens", "userinfo"))
+async def admin_command_denied(message: Message) -> None:
+    """Refuse admin commands from non-admins."""
+    await message.answer("❌ У вас нет доступа к этой команде.")
+
+
+@denied_router.callback_query(F.data.startswith("admin:"))
+async def admin_callback_denied(callback: CallbackQuery) -> None:
+    """Refuse admin buttons from non-admins."""
+    await callback.answer("❌ Нет доступа")
 
 
 def admin_menu_keyboard():
@@ -63,39 +93,86 @@ def admin_menu_keyboard():
     return builder.as_markup()
 
 
+def back_to_admin_keyboard():
+    """Create keyboard with a single button back to admin stats."""
+    builder = InlineKeyboardBuilder()
+    
+    builder.row(
+        InlineKeyboardButton(
+            text="◀️ Назад",
+            callback_data="admin:back",
+        )
+    )
+    
+    return builder.as_markup()
+
+
+# Admin keyboards are static, so build them once
+_ADMIN_MENU_MARKUP = admin_menu_keyboard()
+_BACK_TO_ADMIN_MARKUP = back_to_admin_keyboard()
+
+
 @router.message(Command("admin"))
 async def admin_command(message: Message) -> None:
     """Show admin menu."""
-    if not config.is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде.")
-        return
-    
     await message.answer(
         text=(
             "🔐 <b>Админ-панель</b>\n\n"
             "Выберите действие:"
         ),
-        reply_markup=admin_menu_keyboard(),
+        reply_markup=_ADMIN_MENU_MARKUP,
     )
 
 
 @router.message(Command("stats"))
 async def stats_command(message: Message) -> None:
     """Show bot statistics."""
-    if not config.is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде.")
-        return
-    
     await _send_stats(message)
 
 
-async def _send_stats(message_or_callback) -> None:
-    """Send statistics message."""
-    session_maker = get_session_maker()
-    
-    async with session_maker() as session:
-        stats_repo = StatsRepository(session)
-        stats = await stats_repo.get_full_stats()
+async def _get_cached_stats(
+    key: str,
+    loader: Callable[[StatsRepository], Awaitable[Any]],
+) -> Any:
+    """Return cached stats for key, reloading via loader once the TTL expires."""
+    cached = _STATS_CACHE.get(key)
+    if cached is not None and time.monotonic() - cached[0] < _STATS_TTL:
+        return cached[1]
+    
+    async with _STATS_LOCKS[key]:
+        # Another coroutine may have rebuilt it while we waited
+        cached = _STATS_CACHE.get(key)
+        if cached is not None and time.monotonic() - cached[0] < _STATS_TTL:
+            return cached[1]
+        
+        session_maker = get_session_maker()
+        
+        async with session_maker() as session:
+            data = await loader(StatsRepository(session))
+        
+        _STATS_CACHE[key] = (time.monotonic(), data)
+        return data
+
+
+_STATS_TEMPLATE = (
+    "📊 <b>Статистика бота</b>\n\n"
+    "<b>Пользователи:</b>\n"
+    "  • Всего: {total_users}\n"
+    "  • Новых сегодня: {users_today}\n"
+    "  • Активных сегодня: {active_users_today}\n\n"
+    "<b>Задачи:</b>\n"
+    "  • Всего: {total_tasks}\n"
+    "  • Сегодня: {tasks_today}\n\n"
+    "<b>По статусам:</b>\n{status_text}\n\n"
+    "<b>Токены:</b>\n"
+    "  • Потрачено всего: {total_tokens_spent:,} 🪙\n\n"
+    "<i>Обновлено: {updated_at}</i>"
+)
+
+
+async def _load_stats_text(stats_repo: StatsRepository) -> str:
+    """Load stats and render them once per cache fill."""
+    stats = await stats_repo.get_full_stats()
     
     # Format status counts
     status_text = "\n".join([
@@ -103,50 +180,49 @@ async def _send_stats(message_or_callback) -> None:
         for status, count in stats["tasks_by_status"].items()
     ]) or "  Нет данных"
     
-    text = (
-        f"📊 <b>Статистика бота</b>\n\n"
-        f"<b>Пользователи:</b>\n"
-        f"  • Всего: {stats['total_users']}\n"
-        f"  • Новых сегодня: {stats['users_today']}\n"
-        f"  • Активных сегодня: {stats['active_users_today']}\n\n"
-        f"<b>Задачи:</b>\n"
-        f"  • Всего: {stats['total_tasks']}\n"
-        f"  • Сегодня: {stats['tasks_today']}\n\n"
-        f"<b>По статусам:</b>\n{status_text}\n\n"
-        f"<b>Токены:</b>\n"
-        f"  • Потрачено всего: {stats['total_tokens_spent']:,} 🪙\n\n"
-        f"<i>Обновлено: {datetime.now().strftime('%H:%M:%S')}</i>"
+    return _STATS_TEMPLATE.format(
+        **stats,
+        status_text=status_text,
+        updated_at=datetime.now().strftime("%H:%M:%S"),
     )
+
+
+async def _send_stats(message_or_callback) -> None:
+    """Send statistics message."""
+    text = await _get_cached_stats("full", _load_stats_text)
     
     if isinstance(message_or_callback, CallbackQuery):
-        await message_or_callback.message.edit_text(
-            text=text,
-            reply_markup=admin_menu_keyboard(),
-        )
+        try:
+            await message_or_callback.message.edit_text(
+                text=text,
+                reply_markup=_ADMIN_MENU_MARKUP,
+            )
+        except TelegramBadRequest as e:
+            # Cached stats within the TTL render the same text
+            if "message is not modified" not in str(e):
+                raise
         await message_or_callback.answer("Статистика обновлена")
     else:
         await message_or_callback.answer(
             text=text,
-            reply_markup=admin_menu_keyboard(),
+            reply_markup=_ADMIN_MENU_MARKUP,
         )
 
 
 @router.callback_query(F.data == "admin:stats")
 async def admin_stats_callback(callback: CallbackQuery) -> None:
     """Handle stats button click."""
-    if not config.is_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа")
-        return
-    
     await _send_stats(callback)
 
 
 @router.callback_query(F.data == "admin:refresh")
 async def admin_refresh_callback(callback: CallbackQuery) -> None:
     """Handle refresh button click."""
-    if not config.is_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа")
+    now = time.monotonic()
+    if now - _LAST_REFRESH.get(callback.from_user.id, 0.0) < _REFRESH_MIN_INTERVAL:
+        await callback.answer("⏳ Подождите…")
         return
+    _LAST_REFRESH[callback.from_user.id] = now
     
     await _send_stats(callback)
 
@@ -154,15 +230,9 @@ async def admin_refresh_callback(callback: CallbackQuery) -> None:
 @router.callback_query(F.data == "admin:top_users")
 async def admin_top_users_callback(callback: CallbackQuery) -> None:
     """Show top users by task count."""
-    if not config.is_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа")
-        return
-    
-    session_maker = get_session_maker()
-    
-    async with session_maker() as session:
-        stats_repo = StatsRepository(session)
-        top_users = await stats_repo.get_top_users(limit=10)
+    top_users = await _get_cached_stats(
+        "top_users", lambda stats_repo: stats_repo.get_top_users(limit=10)
+    )
     
     if not top_users:
         text = "👥 <b>Топ пользователей</b>\n\nНет данных"
@@ -173,17 +243,9 @@ async def admin_top_users_callback(callback: CallbackQuery) -> None:
         ])
         text = f"👥 <b>Топ 10 пользователей</b>\n\n{users_text}"
     
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(
-            text="◀️ Назад",
-            callback_data="admin:back",
-        )
-    )
-    
     await callback.message.edit_text(
         text=text,
-        reply_markup=builder.as_markup(),
+        reply_markup=_BACK_TO_ADMIN_MARKUP,
     )
     await callback.answer()
 
@@ -191,15 +253,9 @@ async def admin_top_users_callback(callback: CallbackQuery) -> None:
 @router.callback_query(F.data == "admin:model_usage")
 async def admin_model_usage_callback(callback: CallbackQuery) -> None:
     """Show model usage statistics."""
-    if not config.is_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа")
-        return
-    
-    session_maker = get_session_maker()
-    
-    async with session_maker() as session:
-        stats_repo = StatsRepository(session)
-        model_usage = await stats_repo.get_model_usage()
+    model_usage = await _get_cached_stats(
+        "model_usage", lambda stats_repo: stats_repo.get_model_usage()
+    )
     
     if not model_usage:
         text = "📈 <b>Использование моделей</b>\n\nНет данных"
@@ -207,21 +263,13 @@ async def admin_model_usage_callback(callback: CallbackQuery) -> None:
         total = sum(model_usage.values())
         models_text = "\n".join([
             f"  • {model}: {count} ({count * 100 // total}%)"
-            for model, count in sorted(model_usage.items(), key=lambda x: -x[1])
+            for model, count in model_usage.items()
         ])
         text = f"📈 <b>Использование моделей</b>\n\n{models_text}\n\nВсего: {total}"
     
-    builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(
-            text="◀️ Назад",
-            callback_data="admin:back",
-        )
-    )
-    
     await callback.message.edit_text(
         text=text,
-        reply_markup=builder.as_markup(),
+        reply_markup=_BACK_TO_ADMIN_MARKUP,
     )
     await callback.answer()
 
@@ -229,20 +277,12 @@ async def admin_model_usage_callback(callback: CallbackQuery) -> None:
 @router.callback_query(F.data == "admin:back")
 async def admin_back_callback(callback: CallbackQuery) -> None:
     """Go back to admin menu."""
-    if not config.is_admin(callback.from_user.id):
-        await callback.answer("❌ Нет доступа")
-        return
-    
     await _send_stats(callback)
 
 
 @router.message(Command("addtokens"))
 async def add_tokens_command(message: Message) -> None:
     """Add tokens to a user. Usage: /addtokens <telegram_id> <amount>"""
-    if not config.is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде.")
-        return
-    
     # Parse arguments
     args = message.text.split()[1:]  # Remove /addtokens
     
@@ -292,10 +332,6 @@ async def add_tokens_command(message: Message) -> None:
 @router.message(Command("userinfo"))
 async def user_info_command(message: Message) -> None:
     """Get user info. Usage: /userinfo <telegram_id>"""
-    if not config.is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде.")
-        return
-    
     args = message.text.split()[1:]
     
     if len(args) != 1:
@@ -322,12 +358,12 @@ async def user_info_command(message: Message) -> None:
             return
         
         # Count user's tasks
-        from bot.db.repositories import TaskRepository
         task_repo = TaskRepository(session)
-        history = await task_repo.get_user_history(user.id, limit=100)
+        counts = await task_repo.count_by_status(user.id)
         
-        done_count = sum(1 for t in history if t.status == "done")
-        failed_count = sum(1 for t in history if t.status == "failed")
+        total_count = sum(counts.values())
+        done_count = counts.get("done", 0)
+        failed_count = counts.get("failed", 0)
     
     await message.answer(
         f"👤 <b>Информация о пользователе</b>\n\n"
@@ -339,7 +375,7 @@ async def user_info_command(message: Message) -> None:
         f"<b>Качество:</b> {user.image_quality}\n"
         f"<b>Размер:</b> {user.image_size}\n\n"
         f"<b>Задачи:</b>\n"
-        f"  • Всего: {len(history)}\n"
+        f"  • Всего: {total_count}\n"
         f"  • Успешных: {done_count}\n"
         f"  • Неудачных: {failed_count}\n\n"
         f"<b>Регистрация:</b> {user.created_at.strftime('%d.%m.%Y %H:%M') if user.created_at else '—'}"
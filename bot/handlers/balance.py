@@ -27,7 +27,7 @@ async def cmd_balance(message: Message) -> None:
     session_maker = get_session_maker()
     async with session_maker() as session:
         user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_snapshot(user_tg.id)
 
     if user is None:
         await message.answer(
@@ -1,14 +1,17 @@
 """Handler for image editing flow."""
 
 import logging
+import os
 
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, PhotoSize
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.config import config
-from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.middlewares import DbSessionMiddleware
+from bot.handlers._common import answer_if_unchanged
+from bot.db.repositories import UserRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import estimate_image_tokens, is_valid_quality, is_valid_size
 from bot.keyboards.inline import (
@@ -18,14 +21,19 @@ from bot.keyboards.inline import (
     main_menu_keyboard,
 )
 from bot.states.generation import EditStates
+from bot.tasks.generation import enqueue_in_background
+from bot.utils.helpers import escape_prompt_preview
+from bot.utils.messages import EDIT_TASK_CREATED
 
 logger = logging.getLogger(__name__)
 
 router = Router(name="edit")
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
 
 
 def _build_confirmation_text(
-    prompt: str,
+    prompt_preview: str,
     balance: int,
     cost: int,
     quality: str,
@@ -33,7 +41,6 @@ def _build_confirmation_text(
     model: str,
     second_confirm: bool = False,
 ) -> str:
-    prompt_preview = prompt[:500] + "..." if len(prompt) > 500 else prompt
     confirm_line = "Подтвердить редактирование ещё раз?" if second_confirm else "Подтвердить редактирование?"
     return (
         f"✏️ <b>Подтверждение редактирования</b>\n\n"
@@ -48,8 +55,8 @@ def _build_confirmation_text(
     )
 
 # Supported image formats
-SUPPORTED_FORMATS = {"image/jpeg", "image/png", "image/webp", "image/jpg"}
-SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+SUPPORTED_FORMATS = frozenset({"image/jpeg", "image/png", "image/webp", "image/jpg"})
+SUPPORTED_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
 
 
 def validate_image_format(file_name: str | None, mime_type: str | None) -> bool:
@@ -69,16 +76,13 @@ def validate_image_format(file_name: str | None, mime_type: str | None) -> bool:
     
     # Check file extension
     if file_name:
-        file_name_lower = file_name.lower()
-        for ext in SUPPORTED_EXTENSIONS:
-            if file_name_lower.endswith(ext):
-                return True
+        return os.path.splitext(file_name.lower())[1] in SUPPORTED_EXTENSIONS
     
     return False
 
 
 @router.message(EditStates.waiting_image, F.photo)
-async def process_photo(message: Message, state: FSMContext) -> None:
+async def process_photo(message: Message, state: FSMContext, session: AsyncSession) -> None:
     """
     Process uploaded photo for editing.
     
@@ -90,19 +94,16 @@ async def process_photo(message: Message, state: FSMContext) -> None:
     
     # Get user info
     user_tg = message.from_user
-    session_maker = get_session_maker()
+    user_repo = UserRepository(session)
+    user = await user_repo.get_settings_tuple(user_tg.id)
     
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
-        
-        if user is None:
-            await message.answer(
-                "❌ Пользователь не найден. Используйте /start",
-                reply_markup=back_keyboard(),
-            )
-            await state.clear()
-            return
+    if user is None:
+        await message.answer(
+            "❌ Пользователь не найден. Используйте /start",
+            reply_markup=back_keyboard(),
+        )
+        await state.clear()
+        return
     
     # Save photo file_id to state
     await state.update_data(
@@ -125,7 +126,11 @@ async def process_photo(message: Message, state: FSMContext) -> None:
 
 
 @router.message(EditStates.waiting_image, F.document)
-async def process_document_image(message: Message, state: FSMContext) -> None:
+async def process_document_image(
+    message: Message,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """
     Process uploaded document (image file) for editing.
     
@@ -152,19 +157,16 @@ async def process_document_image(message: Message, state: FSMContext) -> None:
     
     # Get user info
     user_tg = message.from_user
-    session_maker = get_session_maker()
+    user_repo = UserRepository(session)
+    user = await user_repo.get_settings_tuple(user_tg.id)
     
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
-        
-        if user is None:
-            await message.answer(
-                "❌ Пользователь не найден. Используйте /start",
-                reply_markup=back_keyboard(),
-            )
-            await state.clear()
-            return
+    if user is None:
+        await message.answer(
+            "❌ Пользователь не найден. Используйте /start",
+            reply_markup=back_keyboard(),
+        )
+        await state.clear()
+        return
     
     # Save file_id to state
     await state.update_data(
@@ -195,7 +197,7 @@ async def invalid_image_input(message: Message) -> None:
 
 
 @router.message(EditStates.waiting_edit_prompt, F.text)
-async def process_edit_prompt(message: Message, state: FSMContext) -> None:
+async def process_edit_prompt(message: Message, state: FSMContext, session: AsyncSession) -> None:
     """
     Process the edit description/prompt.
     
@@ -221,32 +223,32 @@ async def process_edit_prompt(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     user_id = data.get("user_id")
     
-    session_maker = get_session_maker()
-    
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(message.from_user.id)
-        if user is None:
-            await message.answer(
-                "❌ Пользователь не найден. Используйте /start",
-                reply_markup=back_keyboard(),
-            )
-            await state.clear()
-            return
+    user_repo = UserRepository(session)
+    user = await user_repo.get_settings_tuple(message.from_user.id)
+    if user is None:
+        await message.answer(
+            "❌ Пользователь не найден. Используйте /start",
+            reply_markup=back_keyboard(),
+        )
+        await state.clear()
+        return
 
-        balance = user.tokens
-        quality = user.image_quality
-        size = user.image_size
-        model = user.selected_model
+    balance = user.tokens
+    quality = user.image_quality
+    size = user.image_size
+    model = user.selected_model
 
     cost = estimate_image_tokens(quality, size)
 
-    # Save prompt to state
+    # Save prompt to state; the preview is reused by every re-render
+    prompt_preview = escape_prompt_preview(prompt)
     await state.update_data(
         prompt=prompt,
+        prompt_preview=prompt_preview,
         image_quality=quality,
         image_size=size,
         model=model,
+        balance=balance,
         expensive_confirmed=False,
     )
     await state.set_state(EditStates.confirm_edit)
@@ -254,7 +256,7 @@ async def process_edit_prompt(message: Message, state: FSMContext) -> None:
     # Show confirmation
     await message.answer(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=quality,
@@ -269,10 +271,14 @@ async def process_edit_prompt(message: Message, state: FSMContext) -> None:
     EditStates.confirm_edit,
     F.data.startswith(CallbackData.IMAGE_QUALITY_PREFIX),
 )
-async def set_edit_quality(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_edit_quality(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle quality selection while confirming edit."""
 
-    value = callback.data.replace(CallbackData.IMAGE_QUALITY_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_QUALITY_PREFIX)
     if not is_valid_quality(value):
         await callback.answer("❌ Неверное качество")
         return
@@ -288,19 +294,21 @@ async def set_edit_quality(callback: CallbackQuery, state: FSMContext) -> None:
         await state.clear()
         return
 
-    await state.update_data(image_quality=value, expensive_confirmed=False)
+    if await answer_if_unchanged(callback, value, data.get("image_quality")):
+        return
+
+    prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
+
+    user_repo = UserRepository(session)
+    user = await user_repo.update_image_settings(user_id=user_id, image_quality=value)
+    balance = user.tokens if user else 0
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_quality=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
+    await state.update_data(image_quality=value, balance=balance, expensive_confirmed=False)
 
     cost = estimate_image_tokens(value, size)
     await callback.message.edit_text(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=value,
@@ -316,10 +324,10 @@ async def set_edit_quality(callback: CallbackQuery, state: FSMContext) -> None:
     EditStates.confirm_edit,
     F.data.startswith(CallbackData.IMAGE_SIZE_PREFIX),
 )
-async def set_edit_size(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_edit_size(callback: CallbackQuery, state: FSMContext, session: AsyncSession) -> None:
     """Handle size selection while confirming edit."""
 
-    value = callback.data.replace(CallbackData.IMAGE_SIZE_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_SIZE_PREFIX)
     if not is_valid_size(value):
         await callback.answer("❌ Неверный формат")
         return
@@ -335,19 +343,21 @@ async def set_edit_size(callback: CallbackQuery, state: FSMContext) -> None:
         await state.clear()
         return
 
-    await state.update_data(image_size=value, expensive_confirmed=False)
+    if await answer_if_unchanged(callback, value, data.get("image_size")):
+        return
+
+    prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
+
+    user_repo = UserRepository(session)
+    user = await user_repo.update_image_settings(user_id=user_id, image_size=value)
+    balance = user.tokens if user else 0
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_size=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
+    await state.update_data(image_size=value, balance=balance, expensive_confirmed=False)
 
     cost = estimate_image_tokens(quality, value)
     await callback.message.edit_text(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=quality,
@@ -369,7 +379,7 @@ async def invalid_edit_prompt_input(message: Message) -> None:
 
 
 @router.callback_query(EditStates.confirm_edit, F.data == CallbackData.CONFIRM)
-async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
+async def confirm_edit(callback: CallbackQuery, state: FSMContext, session: AsyncSession) -> None:
     """
     Confirm and start the edit task.
     
@@ -398,16 +408,17 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     cost = estimate_image_tokens(quality, size)
 
     if cost >= config.high_cost_threshold and not expensive_confirmed:
-        session_maker = get_session_maker()
-        async with session_maker() as session:
+        prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
+        # Balance is kept in state by the prompt and settings handlers
+        balance = data.get("balance")
+        if balance is None:
             user_repo = UserRepository(session)
-            user = await user_repo.get_by_telegram_id(callback.from_user.id)
-            balance = user.tokens if user else 0
+            balance = await user_repo.get_tokens(callback.from_user.id) or 0
 
         await state.update_data(expensive_confirmed=True)
         await callback.message.edit_text(
             text=_build_confirmation_text(
-                prompt=prompt,
+                prompt_preview=prompt_preview,
                 balance=balance,
                 cost=cost,
                 quality=quality,
@@ -424,62 +435,54 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer("Подтвердите ещё раз")
         return
     
-    session_maker = get_session_maker()
+    balance_service = BalanceService(session)
     
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
+    try:
+        # Deduct tokens and create task with source image atomically
+        task = await balance_service.deduct_and_create_task(
+            user_id,
+            cost,
+            task_type="edit",
+            prompt=prompt,
+            model=model,
+            image_quality=quality,
+            image_size=size,
+            source_image_url=source_file_id,  # Store file_id as source
+        )
         
-        try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-            
-            # Create task with source image
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="edit",
-                prompt=prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-                source_image_url=source_file_id,  # Store file_id as source
-            )
-            
-            logger.info(f"Created edit task {task.id} for user {user_id}")
-            
-        except InsufficientBalanceError as e:
+        if task is None:
             await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
+                "❌ Пользователь не найден. Используйте /start",
                 reply_markup=main_menu_keyboard(),
             )
             await state.clear()
             await callback.answer()
             return
+        
+        logger.info(f"Created edit task {task.id} for user {user_id}")
+        
+    except InsufficientBalanceError as e:
+        await callback.message.edit_text(
+            text=(
+                f"❌ <b>Недостаточно токенов</b>\n\n"
+                f"Требуется: {e.required} 🪙\n"
+                f"Ваш баланс: {e.available} 🪙\n\n"
+                "Пополните баланс в разделе «Купить токены»"
+            ),
+            reply_markup=main_menu_keyboard(),
+        )
+        await state.clear()
+        await callback.answer()
+        return
     
     # Clear state
     await state.clear()
     
-    # Enqueue task to RQ
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
+    # Enqueue task to RQ in the background; the reply below doesn't wait for Redis
+    enqueue_in_background(task.id)
     
     await callback.message.edit_text(
-        text=(
-            "✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n\n"
-            "⏳ Ваше изображение редактируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
+        text=EDIT_TASK_CREATED.format(task_id=task.id),
         reply_markup=main_menu_keyboard(),
     )
     await callback.answer("Редактирование запущено! ⏳")
@@ -489,7 +492,11 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     EditStates.confirm_edit,
     F.data == CallbackData.EXPENSIVE_CONFIRM,
 )
-async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) -> None:
+async def confirm_edit_expensive(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Second step confirmation for expensive edit."""
 
     data = await state.get_data()
@@ -511,57 +518,51 @@ async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) ->
 
     cost = estimate_image_tokens(quality, size)
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
-
-        try:
-            await balance_service.deduct_tokens(user_id, cost)
-
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="edit",
-                prompt=prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-                source_image_url=source_file_id,
-            )
+    balance_service = BalanceService(session)
 
-            logger.info(f"Created edit task {task.id} for user {user_id}")
+    try:
+        task = await balance_service.deduct_and_create_task(
+            user_id,
+            cost,
+            task_type="edit",
+            prompt=prompt,
+            model=model,
+            image_quality=quality,
+            image_size=size,
+            source_image_url=source_file_id,
+        )
 
-        except InsufficientBalanceError as e:
+        if task is None:
             await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
+                "❌ Пользователь не найден. Используйте /start",
                 reply_markup=main_menu_keyboard(),
             )
             await state.clear()
             await callback.answer()
             return
 
+        logger.info(f"Created edit task {task.id} for user {user_id}")
+
+    except InsufficientBalanceError as e:
+        await callback.message.edit_text(
+            text=(
+                f"❌ <b>Недостаточно токенов</b>\n\n"
+                f"Требуется: {e.required} 🪙\n"
+                f"Ваш баланс: {e.available} 🪙\n\n"
+                "Пополните баланс в разделе «Купить токены»"
+            ),
+            reply_markup=main_menu_keyboard(),
+        )
+        await state.clear()
+        await callback.answer()
+        return
+
     await state.clear()
 
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
+    enqueue_in_background(task.id)
 
     await callback.message.edit_text(
-        text=(
-            "✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n\n"
-            "⏳ Ваше изображение редактируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
+        text=EDIT_TASK_CREATED.format(task_id=task.id),
         reply_markup=main_menu_keyboard(),
     )
     await callback.answer("Редактирование запущено! ⏳")
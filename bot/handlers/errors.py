@@ -7,6 +7,7 @@ from aiogram import Router
 from aiogram.types import Update, ErrorEvent
 from aiogram.exceptions import TelegramAPIError
 
+from bot.bot import get_bot
 from bot.keyboards.inline import main_menu_keyboard
 
 logger = logging.getLogger(__name__)
@@ -61,7 +62,6 @@ async def global_error_handler(event: ErrorEvent) -> bool:
     # Try to send error message to user
     if chat_id:
         try:
-            from bot.bot import get_bot
             bot = get_bot()
             
             await bot.send_message(
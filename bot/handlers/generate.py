@@ -5,10 +5,12 @@ import logging
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.config import config
-from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.middlewares import DbSessionMiddleware
+from bot.handlers._common import answer_if_unchanged
+from bot.db.repositories import UserRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import estimate_image_tokens, is_valid_quality, is_valid_size
 from bot.keyboards.inline import (
@@ -18,14 +20,36 @@ from bot.keyboards.inline import (
     main_menu_keyboard,
 )
 from bot.states.generation import GenerationStates
+from bot.tasks.generation import enqueue_in_background
+from bot.utils.helpers import escape_prompt_preview
+from bot.utils.messages import GENERATE_TASK_CREATED
 
 logger = logging.getLogger(__name__)
 
 router = Router(name="generate")
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
+
+
+_CONFIRM_TEMPLATE = (
+    "🎨 <b>Подтверждение генерации</b>\n\n"
+    "<b>Ваш промпт:</b>\n<i>{prompt_preview}</i>\n\n"
+    "<b>Модель:</b> {model}\n"
+    "<b>Качество:</b> {quality}\n"
+    "<b>Формат:</b> {size}\n\n"
+    "<b>Стоимость:</b> {cost} 🪙\n"
+    "<b>Ваш баланс:</b> {balance} 🪙\n"
+    "<b>После генерации:</b> {remaining} 🪙\n"
+    "{warning}\n\n"
+    "{confirm_line}"
+)
+_EXPENSIVE_WARNING = "\n⚠️ <b>Внимание:</b> дорогая генерация."
+_CONFIRM_ONCE = "Подтвердить генерацию?"
+_CONFIRM_TWICE = "Подтвердить генерацию ещё раз?"
 
 
 def _build_confirmation_text(
-    prompt: str,
+    prompt_preview: str,
     balance: int,
     cost: int,
     quality: str,
@@ -33,26 +57,21 @@ def _build_confirmation_text(
     model: str,
     second_confirm: bool = False,
 ) -> str:
-    warning = "\n⚠️ <b>Внимание:</b> дорогая генерация." if cost >= config.high_cost_threshold else ""
-
-    confirm_line = "Подтвердить генерацию ещё раз?" if second_confirm else "Подтвердить генерацию?"
-
-    return (
-        f"🎨 <b>Подтверждение генерации</b>\n\n"
-        f"<b>Ваш промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>\n\n"
-        f"<b>Модель:</b> {model}\n"
-        f"<b>Качество:</b> {quality}\n"
-        f"<b>Формат:</b> {size}\n\n"
-        f"<b>Стоимость:</b> {cost} 🪙\n"
-        f"<b>Ваш баланс:</b> {balance} 🪙\n"
-        f"<b>После генерации:</b> {balance - cost} 🪙\n"
-        f"{warning}\n\n"
-        f"{confirm_line}"
+    return _CONFIRM_TEMPLATE.format(
+        prompt_preview=prompt_preview,
+        model=model,
+        quality=quality,
+        size=size,
+        cost=cost,
+        balance=balance,
+        remaining=balance - cost,
+        warning=_EXPENSIVE_WARNING if cost >= config.high_cost_threshold else "",
+        confirm_line=_CONFIRM_TWICE if second_confirm else _CONFIRM_ONCE,
     )
 
 
 @router.message(GenerationStates.waiting_prompt, F.text)
-async def process_prompt(message: Message, state: FSMContext) -> None:
+async def process_prompt(message: Message, state: FSMContext, session: AsyncSession) -> None:
     """
     Process the user's prompt for image generation.
     
@@ -76,34 +95,34 @@ async def process_prompt(message: Message, state: FSMContext) -> None:
     
     # Get user balance
     user_tg = message.from_user
-    session_maker = get_session_maker()
+    user_repo = UserRepository(session)
+    user = await user_repo.get_settings_tuple(user_tg.id)
     
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
-        
-        if user is None:
-            await message.answer(
-                "❌ Пользователь не найден. Используйте /start",
-                reply_markup=back_keyboard(),
-            )
-            await state.clear()
-            return
-        
-        balance = user.tokens
-        quality = user.image_quality
-        size = user.image_size
-        model = user.selected_model
+    if user is None:
+        await message.answer(
+            "❌ Пользователь не найден. Используйте /start",
+            reply_markup=back_keyboard(),
+        )
+        await state.clear()
+        return
+    
+    balance = user.tokens
+    quality = user.image_quality
+    size = user.image_size
+    model = user.selected_model
 
     cost = estimate_image_tokens(quality, size)
 
-    # Save prompt to state
+    # Save prompt to state; the preview is reused by every re-render
+    prompt_preview = escape_prompt_preview(prompt)
     await state.update_data(
         prompt=prompt,
+        prompt_preview=prompt_preview,
         user_id=user.id,
         image_quality=quality,
         image_size=size,
         model=model,
+        balance=balance,
         expensive_confirmed=False,
     )
     await state.set_state(GenerationStates.confirm_generation)
@@ -111,7 +130,7 @@ async def process_prompt(message: Message, state: FSMContext) -> None:
     # Show confirmation
     await message.answer(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=quality,
@@ -126,10 +145,14 @@ async def process_prompt(message: Message, state: FSMContext) -> None:
     GenerationStates.confirm_generation,
     F.data.startswith(CallbackData.IMAGE_QUALITY_PREFIX),
 )
-async def set_generation_quality(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_generation_quality(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle quality selection while confirming generation."""
 
-    value = callback.data.replace(CallbackData.IMAGE_QUALITY_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_QUALITY_PREFIX)
     if not is_valid_quality(value):
         await callback.answer("❌ Неверное качество")
         return
@@ -145,19 +168,20 @@ async def set_generation_quality(callback: CallbackQuery, state: FSMContext) ->
         await state.clear()
         return
 
-    await state.update_data(image_quality=value, expensive_confirmed=False)
+    if await answer_if_unchanged(callback, value, data.get("image_quality")):
+        return
+
+    prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
+    user_repo = UserRepository(session)
+    user = await user_repo.update_image_settings(user_id=user_id, image_quality=value)
+    balance = user.tokens if user else 0
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_quality=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
+    await state.update_data(image_quality=value, balance=balance, expensive_confirmed=False)
 
     cost = estimate_image_tokens(value, size)
     await callback.message.edit_text(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=value,
@@ -173,10 +197,14 @@ async def set_generation_quality(callback: CallbackQuery, state: FSMContext) ->
     GenerationStates.confirm_generation,
     F.data.startswith(CallbackData.IMAGE_SIZE_PREFIX),
 )
-async def set_generation_size(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_generation_size(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle size selection while confirming generation."""
 
-    value = callback.data.replace(CallbackData.IMAGE_SIZE_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_SIZE_PREFIX)
     if not is_valid_size(value):
         await callback.answer("❌ Неверный формат")
         return
@@ -192,19 +220,20 @@ async def set_generation_size(callback: CallbackQuery, state: FSMContext) -> Non
         await state.clear()
         return
 
-    await state.update_data(image_size=value, expensive_confirmed=False)
+    if await answer_if_unchanged(callback, value, data.get("image_size")):
+        return
+
+    prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
+    user_repo = UserRepository(session)
+    user = await user_repo.update_image_settings(user_id=user_id, image_size=value)
+    balance = user.tokens if user else 0
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_size=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
+    await state.update_data(image_size=value, balance=balance, expensive_confirmed=False)
 
     cost = estimate_image_tokens(quality, value)
     await callback.message.edit_text(
         text=_build_confirmation_text(
-            prompt=prompt,
+            prompt_preview=prompt_preview,
             balance=balance,
             cost=cost,
             quality=quality,
@@ -216,11 +245,21 @@ async def set_generation_size(callback: CallbackQuery, state: FSMContext) -> Non
     await callback.answer()
 
 
-@router.callback_query(GenerationStates.confirm_generation, F.data == CallbackData.CONFIRM)
-async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None:
+@router.callback_query(
+    GenerationStates.confirm_generation,
+    F.data.in_({CallbackData.CONFIRM, CallbackData.EXPENSIVE_CONFIRM}),
+)
+async def confirm_generation(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """
     Confirm and start the generation task.
     
+    Expensive generations need a second confirmation (EXPENSIVE_CONFIRM)
+    before the task is created.
+    
     - Deducts tokens
     - Creates GenerationTask with status 'pending'
     - Enqueues task to RQ
@@ -230,9 +269,10 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
     user_id = data.get("user_id")
     quality = data.get("image_quality")
     size = data.get("image_size")
+    model = data.get("model")
     expensive_confirmed = data.get("expensive_confirmed", False)
 
-    if not prompt or not user_id or not quality or not size:
+    if not prompt or not user_id or not quality or not size or not model:
         await callback.message.edit_text(
             "❌ Ошибка: данные сессии потеряны. Попробуйте снова.",
             reply_markup=main_menu_keyboard(),
@@ -243,18 +283,23 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
 
     cost = estimate_image_tokens(quality, size)
 
-    if cost >= config.high_cost_threshold and not expensive_confirmed:
-        session_maker = get_session_maker()
-        async with session_maker() as session:
+    needs_second_confirm = (
+        callback.data == CallbackData.CONFIRM
+        and cost >= config.high_cost_threshold
+        and not expensive_confirmed
+    )
+    if needs_second_confirm:
+        # Balance is kept in state by the prompt and settings handlers
+        balance = data.get("balance")
+        if balance is None:
             user_repo = UserRepository(session)
-            user = await user_repo.get_by_telegram_id(callback.from_user.id)
-            balance = user.tokens if user else 0
-            model = user.selected_model if user else "gpt-image-1"
+            balance = await user_repo.get_tokens(callback.from_user.id) or 0
 
+        prompt_preview = data.get("prompt_preview") or escape_prompt_preview(prompt)
         await state.update_data(expensive_confirmed=True)
         await callback.message.edit_text(
             text=_build_confirmation_text(
-                prompt=prompt,
+                prompt_preview=prompt_preview,
                 balance=balance,
                 cost=cost,
                 quality=quality,
@@ -271,149 +316,53 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
         await callback.answer("Подтвердите ещё раз")
         return
     
-    session_maker = get_session_maker()
-    
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
-        user_repo = UserRepository(session)
-
-        try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-
-            user = await user_repo.get_by_telegram_id(callback.from_user.id)
-            model = user.selected_model if user else "gpt-image-1"
-            
-            # Create task
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="generate",
-                prompt=prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-            )
-            
-            logger.info(f"Created generation task {task.id} for user {user_id}")
-            
-        except InsufficientBalanceError as e:
+    balance_service = BalanceService(session)
+
+    try:
+        # Deduct tokens and create task in one transaction
+        task = await balance_service.deduct_and_create_task(
+            user_id,
+            cost,
+            task_type="generate",
+            prompt=prompt,
+            model=model,
+            image_quality=quality,
+            image_size=size,
+        )
+        
+        if task is None:
             await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
+                "❌ Пользователь не найден. Используйте /start",
                 reply_markup=main_menu_keyboard(),
             )
             await state.clear()
             await callback.answer()
             return
-    
-    # Clear state
-    await state.clear()
-    
-    # Enqueue task to RQ (import here to avoid circular imports)
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
-        # Task is created, worker will pick it up eventually
-    
-    await callback.message.edit_text(
-        text=(
-            "✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n\n"
-            "⏳ Ваше изображение генерируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
-        reply_markup=main_menu_keyboard(),
-    )
-    await callback.answer("Генерация запущена! ⏳")
-
-
-@router.callback_query(
-    GenerationStates.confirm_generation,
-    F.data == CallbackData.EXPENSIVE_CONFIRM,
-)
-async def confirm_generation_expensive(callback: CallbackQuery, state: FSMContext) -> None:
-    """Second step confirmation for expensive generation."""
-
-    data = await state.get_data()
-    prompt = data.get("prompt")
-    user_id = data.get("user_id")
-    quality = data.get("image_quality")
-    size = data.get("image_size")
-
-    if not prompt or not user_id or not quality or not size:
+        
+        logger.info(f"Created generation task {task.id} for user {user_id}")
+        
+    except InsufficientBalanceError as e:
         await callback.message.edit_text(
-            "❌ Ошибка: данные сессии потеряны. Попробуйте снова.",
+            text=(
+                f"❌ <b>Недостаточно токенов</b>\n\n"
+                f"Требуется: {e.required} 🪙\n"
+                f"Ваш баланс: {e.available} 🪙\n\n"
+                "Пополните баланс в разделе «Купить токены»"
+            ),
             reply_markup=main_menu_keyboard(),
         )
         await state.clear()
         await callback.answer()
         return
-
-    cost = estimate_image_tokens(quality, size)
-
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
-        user_repo = UserRepository(session)
-
-        try:
-            await balance_service.deduct_tokens(user_id, cost)
-
-            user = await user_repo.get_by_telegram_id(callback.from_user.id)
-            model = user.selected_model if user else "gpt-image-1"
-
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="generate",
-                prompt=prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-            )
-
-            logger.info(f"Created generation task {task.id} for user {user_id}")
-
-        except InsufficientBalanceError as e:
-            await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
-                reply_markup=main_menu_keyboard(),
-            )
-            await state.clear()
-            await callback.answer()
-            return
-
+    
+    # Clear state
     await state.clear()
-
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
-
+    
+    # Enqueue task to RQ in the background; the reply below doesn't wait for Redis
+    enqueue_in_background(task.id)
+    
     await callback.message.edit_text(
-        text=(
-            "✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n\n"
-            "⏳ Ваше изображение генерируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
+        text=GENERATE_TASK_CREATED.format(task_id=task.id),
         reply_markup=main_menu_keyboard(),
     )
     await callback.answer("Генерация запущена! ⏳")
@@ -86,7 +86,7 @@ async def menu_model(callback: CallbackQuery, state: FSMContext) -> None:
     
     async with session_maker() as session:
         user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_snapshot(user_tg.id)
         current_model = user.selected_model if user else "gpt-image-1"
     
     model_names = {
@@ -117,7 +117,7 @@ async def menu_tokens(callback: CallbackQuery, state: FSMContext) -> None:
     
     async with session_maker() as session:
         user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_snapshot(user_tg.id)
         balance = user.tokens if user else 0
     
     await callback.message.edit_text(
@@ -47,7 +47,7 @@ async def select_gpt_image_1(callback: CallbackQuery) -> None:
     
     async with session_maker() as session:
         user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_settings_tuple(user_tg.id)
         
         if user is None:
             await callback.answer("❌ Пользователь не найден", show_alert=True)
@@ -75,7 +75,7 @@ async def select_gpt_image_15(callback: CallbackQuery) -> None:
     
     async with session_maker() as session:
         user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_settings_tuple(user_tg.id)
         
         if user is None:
             await callback.answer("❌ Пользователь не найден", show_alert=True)
@@ -56,7 +56,7 @@ async def show_profile(callback: CallbackQuery) -> None:
         user_repo = UserRepository(session)
         task_repo = TaskRepository(session)
         
-        user = await user_repo.get_by_telegram_id(user_tg.id)
+        user = await user_repo.get_settings_tuple(user_tg.id)
         
         if user is None:
             await callback.message.edit_text(
@@ -66,12 +66,11 @@ async def show_profile(callback: CallbackQuery) -> None:
             await callback.answer()
             return
         
-        # Get user's generation history
-        history = await task_repo.get_user_history(user.id, limit=10)
-        
-        # Count completed generations
-        total_generations = len(history)
-        successful_generations = sum(1 for t in history if t.status == "done")
+        # Last 10 tasks plus the user's totals, in one query
+        page = await task_repo.get_user_history_page(user.id, limit=10)
+        history = page.tasks
+        total_generations = page.total
+        successful_generations = page.done
     
     # Build profile message
     text = (
@@ -137,8 +136,8 @@ async def show_history_image(callback: CallbackQuery) -> None:
     """Show image from history item."""
     # Extract task_id from callback data
     try:
-        task_id = int(callback.data.split(":")[-1])
-    except (ValueError, IndexError):
+        task_id = int(callback.data.removeprefix("history:show:"))
+    except ValueError:
         await callback.answer("❌ Ошибка: неверный ID задачи")
         return
     
@@ -52,7 +52,7 @@ async def tokens_coming_soon(callback: CallbackQuery) -> None:
 async def buy_tokens(callback: CallbackQuery) -> None:
     """Handle token purchase (placeholder)."""
     # Extract package from callback data
-    package = callback.data.split(":")[-1]
+    package = callback.data.removeprefix("tokens:buy:")
     
     await callback.answer(
         f"💳 Покупка пакета «{package}» скоро будет доступна!",
@@ -5,13 +5,15 @@ import logging
 from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.config import config
-from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.middlewares import DbSessionMiddleware
+from bot.handlers._common import answer_if_unchanged
+from bot.db.repositories import UserRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import estimate_image_tokens, is_valid_quality, is_valid_size
-from bot.templates.prompts import get_template_by_id, get_all_templates
+from bot.templates.prompts import PromptTemplate, get_template_by_id, get_all_templates
 from bot.keyboards.inline import (
     CallbackData,
     templates_keyboard,
@@ -20,20 +22,40 @@ from bot.keyboards.inline import (
     main_menu_keyboard,
 )
 from bot.states.generation import TemplateStates
+from bot.tasks.generation import enqueue_in_background
+from bot.utils.messages import TEMPLATE_TASK_CREATED
 
 logger = logging.getLogger(__name__)
 
 router = Router(name="trends")
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
 
 
 # Note: Main trends menu is handled in menu.py
 # This router handles template selection and confirmation
 
 
+_CONFIRM_TEMPLATE = (
+    "💡 <b>{template_name}</b>\n\n"
+    "<b>Описание:</b>\n{template_description}\n\n"
+    "<b>Промпт:</b>\n<i>{prompt_preview}</i>\n\n"
+    "<b>Модель:</b> {model}\n"
+    "<b>Качество:</b> {quality}\n"
+    "<b>Формат:</b> {size}\n\n"
+    "<b>Стоимость:</b> {cost} 🪙\n"
+    "<b>Ваш баланс:</b> {balance} 🪙\n"
+    "<b>После генерации:</b> {remaining} 🪙\n\n"
+    "{confirm_line}"
+)
+_CONFIRM_ONCE = "Создать изображение по этому шаблону?"
+_CONFIRM_TWICE = "Создать изображение по этому шаблону ещё раз?"
+
+
 def _build_template_confirmation_text(
     template_name: str,
     template_description: str,
-    template_prompt: str,
+    prompt_preview: str,
     balance: int,
     cost: int,
     quality: str,
@@ -41,27 +63,113 @@ def _build_template_confirmation_text(
     model: str,
     second_confirm: bool = False,
 ) -> str:
-    prompt_preview = template_prompt[:300] + "..." if len(template_prompt) > 300 else template_prompt
-    confirm_line = "Создать изображение по этому шаблону ещё раз?" if second_confirm else "Создать изображение по этому шаблону?"
-    return (
-        f"💡 <b>{template_name}</b>\n\n"
-        f"<b>Описание:</b>\n{template_description}\n\n"
-        f"<b>Промпт:</b>\n<i>{prompt_preview}</i>\n\n"
-        f"<b>Модель:</b> {model}\n"
-        f"<b>Качество:</b> {quality}\n"
-        f"<b>Формат:</b> {size}\n\n"
-        f"<b>Стоимость:</b> {cost} 🪙\n"
-        f"<b>Ваш баланс:</b> {balance} 🪙\n"
-        f"<b>После генерации:</b> {balance - cost} 🪙\n\n"
-        f"{confirm_line}"
+    return _CONFIRM_TEMPLATE.format(
+        template_name=template_name,
+        template_description=template_description,
+        prompt_preview=prompt_preview,
+        model=model,
+        quality=quality,
+        size=size,
+        cost=cost,
+        balance=balance,
+        remaining=balance - cost,
+        confirm_line=_CONFIRM_TWICE if second_confirm else _CONFIRM_ONCE,
+    )
+
+
+async def _render_confirmation(
+    callback: CallbackQuery,
+    template: PromptTemplate,
+    *,
+    balance: int,
+    quality: str,
+    size: str,
+    model: str,
+    second_confirm: bool = False,
+) -> None:
+    """Show the template confirmation screen for the given settings."""
+    cost = estimate_image_tokens(quality, size) * template.tokens_cost
+    await callback.message.edit_text(
+        text=_build_template_confirmation_text(
+            template_name=template.name,
+            template_description=template.description,
+            prompt_preview=template.prompt_preview,
+            balance=balance,
+            cost=cost,
+            quality=quality,
+            size=size,
+            model=model,
+            second_confirm=second_confirm,
+        ),
+        reply_markup=image_settings_confirm_keyboard(
+            quality,
+            size,
+            confirm_callback_data=(
+                CallbackData.EXPENSIVE_CONFIRM if second_confirm else CallbackData.CONFIRM
+            ),
+        ),
+    )
+
+
+async def _apply_setting(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+    field: str,
+    value: str,
+) -> None:
+    """Persist a quality/size change and re-render the confirmation."""
+    data = await state.get_data()
+    template_id = data.get("template_id")
+    user_id = data.get("user_id")
+    model = data.get("model")
+    settings = {
+        "image_quality": data.get("image_quality"),
+        "image_size": data.get("image_size"),
+    }
+
+    if not template_id or not user_id or not model or not all(settings.values()):
+        await callback.answer("❌ Ошибка состояния")
+        await state.clear()
+        return
+
+    if await answer_if_unchanged(callback, value, settings[field]):
+        return
+
+    template = get_template_by_id(template_id)
+    if template is None:
+        await callback.answer("❌ Шаблон не найден")
+        await state.clear()
+        return
+
+    settings[field] = value
+
+    user_repo = UserRepository(session)
+    user = await user_repo.update_image_settings(user_id=user_id, **{field: value})
+    balance = user.tokens if user else 0
+
+    await state.update_data(balance=balance, expensive_confirmed=False, **{field: value})
+
+    await _render_confirmation(
+        callback,
+        template,
+        balance=balance,
+        quality=settings["image_quality"],
+        size=settings["image_size"],
+        model=model,
     )
+    await callback.answer()
 
 
 @router.callback_query(F.data.startswith(CallbackData.TEMPLATE_PREFIX))
-async def select_template(callback: CallbackQuery, state: FSMContext) -> None:
+async def select_template(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle template selection from trends menu."""
     # Extract template_id from callback data
-    template_id = callback.data.replace(CallbackData.TEMPLATE_PREFIX, "")
+    template_id = callback.data.removeprefix(CallbackData.TEMPLATE_PREFIX)
     
     template = get_template_by_id(template_id)
     
@@ -71,51 +179,40 @@ async def select_template(callback: CallbackQuery, state: FSMContext) -> None:
     
     # Get user info and balance
     user_tg = callback.from_user
-    session_maker = get_session_maker()
+    user_repo = UserRepository(session)
+    user = await user_repo.get_settings_tuple(user_tg.id)
+    # Read-only from here on: end the transaction and release the
+    # connection before the Telegram round-trips below
+    await session.commit()
     
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        user = await user_repo.get_by_telegram_id(user_tg.id)
-        
-        if user is None:
-            await callback.message.edit_text(
-                "❌ Пользователь не найден. Используйте /start",
-                reply_markup=main_menu_keyboard(),
-            )
-            await callback.answer()
-            return
-        
-        balance = user.tokens
-        quality = user.image_quality
-        size = user.image_size
-        model = user.selected_model
-
-    cost = estimate_image_tokens(quality, size) * template.tokens_cost
+    if user is None:
+        await callback.message.edit_text(
+            "❌ Пользователь не найден. Используйте /start",
+            reply_markup=main_menu_keyboard(),
+        )
+        await callback.answer()
+        return
     
     # Save template to state
     await state.update_data(
         template_id=template_id,
         user_id=user.id,
-        image_quality=quality,
-        image_size=size,
-        model=model,
+        image_quality=user.image_quality,
+        image_size=user.image_size,
+        model=user.selected_model,
+        balance=user.tokens,
         expensive_confirmed=False,
     )
     await state.set_state(TemplateStates.confirm_template)
     
     # Show template details and confirmation
-    await callback.message.edit_text(
-        text=_build_template_confirmation_text(
-            template_name=template.name,
-            template_description=template.description,
-            template_prompt=template.prompt,
-            balance=balance,
-            cost=cost,
-            quality=quality,
-            size=size,
-            model=model,
-        ),
-        reply_markup=image_settings_confirm_keyboard(quality, size),
+    await _render_confirmation(
+        callback,
+        template,
+        balance=user.tokens,
+        quality=user.image_quality,
+        size=user.image_size,
+        model=user.selected_model,
     )
     await callback.answer()
 
@@ -124,117 +221,55 @@ async def select_template(callback: CallbackQuery, state: FSMContext) -> None:
     TemplateStates.confirm_template,
     F.data.startswith(CallbackData.IMAGE_QUALITY_PREFIX),
 )
-async def set_template_quality(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_template_quality(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle quality selection while confirming template generation."""
 
-    value = callback.data.replace(CallbackData.IMAGE_QUALITY_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_QUALITY_PREFIX)
     if not is_valid_quality(value):
         await callback.answer("❌ Неверное качество")
         return
 
-    data = await state.get_data()
-    template_id = data.get("template_id")
-    user_id = data.get("user_id")
-    size = data.get("image_size")
-    model = data.get("model")
-
-    if not template_id or not user_id or not size or not model:
-        await callback.answer("❌ Ошибка состояния")
-        await state.clear()
-        return
-
-    template = get_template_by_id(template_id)
-    if template is None:
-        await callback.answer("❌ Шаблон не найден")
-        await state.clear()
-        return
-
-    await state.update_data(image_quality=value, expensive_confirmed=False)
-
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_quality=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
-
-    cost = estimate_image_tokens(value, size) * template.tokens_cost
-    await callback.message.edit_text(
-        text=_build_template_confirmation_text(
-            template_name=template.name,
-            template_description=template.description,
-            template_prompt=template.prompt,
-            balance=balance,
-            cost=cost,
-            quality=value,
-            size=size,
-            model=model,
-        ),
-        reply_markup=image_settings_confirm_keyboard(value, size),
-    )
-    await callback.answer()
+    await _apply_setting(callback, state, session, "image_quality", value)
 
 
 @router.callback_query(
     TemplateStates.confirm_template,
     F.data.startswith(CallbackData.IMAGE_SIZE_PREFIX),
 )
-async def set_template_size(callback: CallbackQuery, state: FSMContext) -> None:
+async def set_template_size(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """Handle size selection while confirming template generation."""
 
-    value = callback.data.replace(CallbackData.IMAGE_SIZE_PREFIX, "")
+    value = callback.data.removeprefix(CallbackData.IMAGE_SIZE_PREFIX)
     if not is_valid_size(value):
         await callback.answer("❌ Неверный формат")
         return
 
-    data = await state.get_data()
-    template_id = data.get("template_id")
-    user_id = data.get("user_id")
-    quality = data.get("image_quality")
-    model = data.get("model")
-
-    if not template_id or not user_id or not quality or not model:
-        await callback.answer("❌ Ошибка состояния")
-        await state.clear()
-        return
-
-    template = get_template_by_id(template_id)
-    if template is None:
-        await callback.answer("❌ Шаблон не найден")
-        await state.clear()
-        return
-
-    await state.update_data(image_size=value, expensive_confirmed=False)
+    await _apply_setting(callback, state, session, "image_size", value)
 
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        await user_repo.update_image_settings(user_id=user_id, image_size=value)
-        user = await user_repo.get_by_telegram_id(callback.from_user.id)
-        balance = user.tokens if user else 0
 
-    cost = estimate_image_tokens(quality, value) * template.tokens_cost
-    await callback.message.edit_text(
-        text=_build_template_confirmation_text(
-            template_name=template.name,
-            template_description=template.description,
-            template_prompt=template.prompt,
-            balance=balance,
-            cost=cost,
-            quality=quality,
-            size=value,
-            model=model,
-        ),
-        reply_markup=image_settings_confirm_keyboard(quality, value),
-    )
-    await callback.answer()
-
-
-@router.callback_query(TemplateStates.confirm_template, F.data == CallbackData.CONFIRM)
-async def confirm_template_generation(callback: CallbackQuery, state: FSMContext) -> None:
+@router.callback_query(
+    TemplateStates.confirm_template,
+    F.data.in_({CallbackData.CONFIRM, CallbackData.EXPENSIVE_CONFIRM}),
+)
+async def confirm_template_generation(
+    callback: CallbackQuery,
+    state: FSMContext,
+    session: AsyncSession,
+) -> None:
     """
     Confirm and start generation from template.
     
+    Expensive generations need a second confirmation (EXPENSIVE_CONFIRM)
+    before the task is created.
+    
     - Deducts tokens
     - Creates GenerationTask with template prompt
     - Enqueues task to RQ
@@ -267,188 +302,83 @@ async def confirm_template_generation(callback: CallbackQuery, state: FSMContext
         await callback.answer()
         return
     
-    session_maker = get_session_maker()
+    cost = estimate_image_tokens(quality, size) * template.tokens_cost
+
+    needs_second_confirm = (
+        callback.data == CallbackData.CONFIRM
+        and cost >= config.high_cost_threshold
+        and not expensive_confirmed
+    )
+    if needs_second_confirm:
+        # Balance is kept in state by the selection and settings handlers
+        balance = data.get("balance")
+        if balance is None:
+            user_repo = UserRepository(session)
+            balance = await user_repo.get_tokens(callback.from_user.id) or 0
+
+        await state.update_data(expensive_confirmed=True)
+        await _render_confirmation(
+            callback,
+            template,
+            balance=balance,
+            quality=quality,
+            size=size,
+            model=model,
+            second_confirm=True,
+        )
+        await callback.answer("Подтвердите ещё раз")
+        return
+
+    balance_service = BalanceService(session)
     
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
+    try:
+        # Deduct tokens and create task with template prompt in one transaction
+        task = await balance_service.deduct_and_create_task(
+            user_id,
+            cost,
+            task_type="generate",
+            prompt=template.prompt,
+            model=model,
+            image_quality=quality,
+            image_size=size,
+        )
         
-        try:
-            cost = estimate_image_tokens(quality, size) * template.tokens_cost
-
-            if cost >= config.high_cost_threshold and not expensive_confirmed:
-                user_repo = UserRepository(session)
-                user = await user_repo.get_by_telegram_id(callback.from_user.id)
-                balance = user.tokens if user else 0
-
-                await state.update_data(expensive_confirmed=True)
-                await callback.message.edit_text(
-                    text=_build_template_confirmation_text(
-                        template_name=template.name,
-                        template_description=template.description,
-                        template_prompt=template.prompt,
-                        balance=balance,
-                        cost=cost,
-                        quality=quality,
-                        size=size,
-                        model=model,
-                        second_confirm=True,
-                    ),
-                    reply_markup=image_settings_confirm_keyboard(
-                        quality,
-                        size,
-                        confirm_callback_data=CallbackData.EXPENSIVE_CONFIRM,
-                    ),
-                )
-                await callback.answer("Подтвердите ещё раз")
-                return
-
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-            
-            # Create task with template prompt
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="generate",
-                prompt=template.prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-            )
-            
-            logger.info(
-                f"Created template task {task.id} for user {user_id} "
-                f"(template: {template_id})"
-            )
-            
-        except InsufficientBalanceError as e:
+        if task is None:
             await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
+                "❌ Пользователь не найден. Используйте /start",
                 reply_markup=main_menu_keyboard(),
             )
             await state.clear()
             await callback.answer()
             return
-    
-    # Clear state
-    await state.clear()
-    
-    # Enqueue task to RQ
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
-    
-    await callback.message.edit_text(
-        text=(
-            f"✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n"
-            f"📝 Шаблон: {template.name}\n\n"
-            "⏳ Ваше изображение генерируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
-        reply_markup=main_menu_keyboard(),
-    )
-    await callback.answer("Генерация запущена! ⏳")
-
-
-@router.callback_query(
-    TemplateStates.confirm_template,
-    F.data == CallbackData.EXPENSIVE_CONFIRM,
-)
-async def confirm_template_generation_expensive(callback: CallbackQuery, state: FSMContext) -> None:
-    """Second step confirmation for expensive template generation."""
-
-    data = await state.get_data()
-    template_id = data.get("template_id")
-    user_id = data.get("user_id")
-    quality = data.get("image_quality")
-    size = data.get("image_size")
-    model = data.get("model")
-
-    if not template_id or not user_id or not quality or not size or not model:
-        await callback.message.edit_text(
-            "❌ Ошибка: данные сессии потеряны. Попробуйте снова.",
-            reply_markup=main_menu_keyboard(),
+        
+        logger.info(
+            f"Created template task {task.id} for user {user_id} "
+            f"(template: {template_id})"
         )
-        await state.clear()
-        await callback.answer()
-        return
-
-    template = get_template_by_id(template_id)
-    if template is None:
+        
+    except InsufficientBalanceError as e:
         await callback.message.edit_text(
-            "❌ Шаблон не найден.",
+            text=(
+                f"❌ <b>Недостаточно токенов</b>\n\n"
+                f"Требуется: {e.required} 🪙\n"
+                f"Ваш баланс: {e.available} 🪙\n\n"
+                "Пополните баланс в разделе «Купить токены»"
+            ),
             reply_markup=main_menu_keyboard(),
         )
         await state.clear()
         await callback.answer()
         return
-
-    cost = estimate_image_tokens(quality, size) * template.tokens_cost
-
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
-
-        try:
-            await balance_service.deduct_tokens(user_id, cost)
-
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type="generate",
-                prompt=template.prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-            )
-
-            logger.info(
-                f"Created template task {task.id} for user {user_id} "
-                f"(template: {template_id})"
-            )
-
-        except InsufficientBalanceError as e:
-            await callback.message.edit_text(
-                text=(
-                    f"❌ <b>Недостаточно токенов</b>\n\n"
-                    f"Требуется: {e.required} 🪙\n"
-                    f"Ваш баланс: {e.available} 🪙\n\n"
-                    "Пополните баланс в разделе «Купить токены»"
-                ),
-                reply_markup=main_menu_keyboard(),
-            )
-            await state.clear()
-            await callback.answer()
-            return
-
+    
+    # Clear state
     await state.clear()
-
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
-
+    
+    # Enqueue task to RQ in the background; the reply below doesn't wait for Redis
+    enqueue_in_background(task.id)
+    
     await callback.message.edit_text(
-        text=(
-            f"✅ <b>Задача создана!</b>\n\n"
-            f"🆔 ID задачи: <code>{task.id}</code>\n"
-            f"📝 Шаблон: {template.name}\n\n"
-            "⏳ Ваше изображение генерируется...\n"
-            "Я отправлю результат, когда будет готово.\n\n"
-            "Это может занять 10-30 секунд."
-        ),
+        text=TEMPLATE_TASK_CREATED.format(task_id=task.id, template_name=template.name),
         reply_markup=main_menu_keyboard(),
     )
     await callback.answer("Генерация запущена! ⏳")
@@ -1,5 +1,7 @@
 """Inline keyboards for the bot."""
 
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
@@ -41,6 +43,9 @@ class CallbackData:
     IMAGE_SIZE_PREFIX = "img:size:"
 
 
+# Keyboards without arguments are static: they are built once and the same
+# markup object is reused (markups are never mutated after creation).
+@lru_cache(maxsize=1)
 def main_menu_keyboard() -> InlineKeyboardMarkup:
     """
     Create the main menu keyboard with 6 buttons.
@@ -86,6 +91,7 @@ def main_menu_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=64)
 def image_settings_confirm_keyboard(
     current_quality: ImageQuality,
     current_size: ImageSize,
@@ -134,6 +140,7 @@ def image_settings_confirm_keyboard(
     return builder.as_markup()
 
 
+@lru_cache(maxsize=1)
 def templates_keyboard() -> InlineKeyboardMarkup:
     """
     Create keyboard with template options.
@@ -162,6 +169,7 @@ def templates_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=1)
 def confirm_keyboard() -> InlineKeyboardMarkup:
     """
     Create confirmation keyboard.
@@ -185,6 +193,7 @@ def confirm_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=1)
 def back_keyboard() -> InlineKeyboardMarkup:
     """
     Create back to menu keyboard.
@@ -246,6 +255,7 @@ def model_keyboard(current_model: str = "gpt-image-1") -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=1)
 def tokens_keyboard() -> InlineKeyboardMarkup:
     """
     Create tokens purchase keyboard (placeholder).
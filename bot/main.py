@@ -8,15 +8,24 @@ This module provides:
 
 import asyncio
 import logging
+import random
+import secrets
 from contextlib import asynccontextmanager
+from typing import Optional
 
+from aiogram import Bot, Dispatcher
 from aiogram.types import Update
 from fastapi import FastAPI, Request, Response
+from pydantic import BaseModel, ValidationError
 
-from bot.bot import get_bot, get_dispatcher, close_bot
+from bot.bot import get_bot, get_dispatcher, close_bot, close_redis_pool
 from bot.config import config
-from bot.db.database import init_db, close_db, get_session_maker
+from bot.db.database import init_db, close_db, get_session_maker, warm_pool
+from bot.db.repositories import StatsRepository, TaskRepository, UserRepository
+from bot.db.user_cache import close_user_cache
 from bot.handlers import register_all_handlers
+from bot.services.image_provider import close_http_client
+from bot.tasks.generation import get_queue
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +34,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Updates being processed in the background (see webhook())
+_update_tasks: set[asyncio.Task] = set()
+# How long shutdown waits for in-flight updates before closing connections
+_UPDATE_DRAIN_TIMEOUT = 30
+# Upper bound for a single set_webhook retry delay, in seconds
+_WEBHOOK_RETRY_MAX_DELAY = 30.0
+
+# Static info endpoint bodies, hit by probes; encoded once. Responses
+# themselves are built per request: middleware may add headers to them.
+_HEALTH_BODY = b'{"status":"ok"}'
+_ROOT_BODY = b'{"name":"Telegram AI Image Bot","version":"1.0.0","status":"running"}'
+
+# Telegram updates are a few KB; anything far larger isn't from Telegram
+_MAX_WEBHOOK_BODY = 1024 * 1024
+
+# Expected header values, encoded once for constant-time comparison
+_WEBHOOK_SECRET = config.webhook_secret_token.encode()
+_ADMIN_API_KEY = config.admin_api_key.encode()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,13 +61,16 @@ async def lifespan(app: FastAPI):
     
     Startup:
     - Initialize database
+    - Warm up the connection pool
     - Register handlers
     - Set Telegram webhook
     
     Shutdown:
     - Delete Telegram webhook
+    - Wait for in-flight updates
     - Close bot session
     - Close database connections
+    - Close Redis and HTTP client pools
     """
     # Startup
     logger.info("Starting application...")
@@ -52,6 +83,12 @@ async def lifespan(app: FastAPI):
         logger.error(f"Failed to initialize database: {e}")
         raise
     
+    # Pre-open pooled connections so the first updates don't pay for them
+    try:
+        await warm_pool()
+    except Exception as e:
+        logger.warning(f"Failed to warm up database pool: {e}")
+    
     # Get bot and dispatcher
     bot = get_bot()
     dp = get_dispatcher()
@@ -60,6 +97,10 @@ async def lifespan(app: FastAPI):
     register_all_handlers(dp)
     logger.info("Handlers registered")
     
+    # Bound once here so the webhook doesn't go through the lazy getters
+    app.state.bot = bot
+    app.state.dp = dp
+    
     # Set webhook
     if config.disable_webhook:
         logger.warning("Webhook disabled by DISABLE_WEBHOOK=1")
@@ -70,11 +111,16 @@ async def lifespan(app: FastAPI):
         for attempt in range(1, max(config.webhook_max_retries, 1) + 1):
             try:
                 secret_token = config.webhook_secret_token or None
-                await bot.set_webhook(
-                    url=webhook_url,
-                    drop_pending_updates=True,
-                    request_timeout=config.telegram_request_timeout,
-                    secret_token=secret_token,
+                # Hard per-attempt ceiling on top of the HTTP timeout, so a
+                # stuck connection can't hold up startup
+                await asyncio.wait_for(
+                    bot.set_webhook(
+                        url=webhook_url,
+                        drop_pending_updates=True,
+                        request_timeout=config.telegram_request_timeout,
+                        secret_token=secret_token,
+                    ),
+                    timeout=config.telegram_request_timeout + 2,
                 )
                 logger.info(f"Webhook set to: {webhook_url}")
                 break
@@ -90,8 +136,12 @@ async def lifespan(app: FastAPI):
                         config.webhook_max_retries,
                     )
                     break
-                await asyncio.sleep(delay)
-                delay *= max(config.webhook_retry_backoff, 1.0)
+                # Jitter so several workers restarting together don't retry in lockstep
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                delay = min(
+                    delay * max(config.webhook_retry_backoff, 1.0),
+                    _WEBHOOK_RETRY_MAX_DELAY,
+                )
     else:
         logger.warning("WEBHOOK_URL not configured, webhook not set")
     
@@ -108,6 +158,11 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"Failed to delete webhook: {e}")
     
+    # Let in-flight updates finish before their connections go away
+    if _update_tasks:
+        logger.info(f"Waiting for {len(_update_tasks)} in-flight updates...")
+        await asyncio.wait(_update_tasks, timeout=_UPDATE_DRAIN_TIMEOUT)
+    
     # Close bot session
     await close_bot()
     logger.info("Bot session closed")
@@ -116,6 +171,10 @@ async def lifespan(app: FastAPI):
     await close_db()
     logger.info("Database connections closed")
 
+    await close_user_cache()
+    await close_redis_pool()
+    await close_http_client()
+
 
 # Create FastAPI application
 app = FastAPI(
@@ -126,6 +185,25 @@ app = FastAPI(
 )
 
 
+async def _process_update(dp: Dispatcher, bot: Bot, update: Update) -> None:
+    try:
+        await dp.feed_update(bot=bot, update=update)
+    except Exception:
+        logger.exception("Error processing webhook update")
+
+
+async def _read_body(request: Request, limit: int) -> Optional[bytes]:
+    """Read the request body, or return None once it grows past limit."""
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
 @app.post("/webhook")
 async def webhook(request: Request) -> Response:
     """
@@ -134,22 +212,43 @@ async def webhook(request: Request) -> Response:
     Receives updates from Telegram and processes them through aiogram dispatcher.
     """
     try:
-        if config.webhook_secret_token:
-            request_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
-            if request_secret != config.webhook_secret_token:
+        if _WEBHOOK_SECRET:
+            request_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not secrets.compare_digest(request_secret.encode(), _WEBHOOK_SECRET):
                 logger.warning("Webhook request rejected: invalid secret token")
                 return Response(status_code=403)
 
-        # Parse update from request body
-        update_data = await request.json()
-        update = Update.model_validate(update_data)
+        # Reject oversized bodies from the header, before reading them
+        content_length = request.headers.get("Content-Length")
+        if content_length is not None:
+            try:
+                length = int(content_length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                logger.warning("Webhook request rejected: bad Content-Length")
+                return Response(status_code=400)
+            if length > _MAX_WEBHOOK_BODY:
+                logger.warning("Webhook request rejected: body too large")
+                return Response(status_code=413)
+
+        # Chunked or header-less bodies skip the check above; the limit is
+        # enforced again while reading
+        body = await _read_body(request, _MAX_WEBHOOK_BODY)
+        if body is None:
+            logger.warning("Webhook request rejected: body too large")
+            return Response(status_code=413)
         
-        # Get bot and dispatcher
-        bot = get_bot()
-        dp = get_dispatcher()
+        # Parse update straight from the raw body (pydantic's JSON parser,
+        # no intermediate dict)
+        update = Update.model_validate_json(body)
         
-        # Process update
-        await dp.feed_update(bot=bot, update=update)
+        # Process update in the background so Telegram gets its 200 right
+        # away instead of waiting on DB/Redis work in the handlers
+        state = request.app.state
+        task = asyncio.create_task(_process_update(state.dp, state.bot, update))
+        _update_tasks.add(task)
+        task.add_done_callback(_update_tasks.discard)
         
         return Response(status_code=200)
     
@@ -160,29 +259,31 @@ async def webhook(request: Request) -> Response:
 
 
 @app.get("/health")
-async def health_check():
+async def health_check() -> Response:
     """Health check endpoint."""
-    return {"status": "ok"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 @app.get("/")
-async def root():
+async def root() -> Response:
     """Root endpoint with basic info."""
-    return {
-        "name": "Telegram AI Image Bot",
-        "version": "1.0.0",
-        "status": "running",
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 
 # ============== Admin API Endpoints ==============
 
+class AddTokensRequest(BaseModel):
+    """Body of POST /admin/users/{telegram_id}/tokens."""
+
+    amount: int = 0
+
+
 def verify_admin_api_key(request: Request) -> bool:
     """Verify admin API key from request headers."""
-    if not config.admin_api_key:
+    if not _ADMIN_API_KEY:
         return False
-    api_key = request.headers.get("X-Admin-API-Key")
-    return api_key == config.admin_api_key
+    api_key = request.headers.get("X-Admin-API-Key", "")
+    return secrets.compare_digest(api_key.encode(), _ADMIN_API_KEY)
 
 
 @app.get("/admin/stats")
@@ -195,8 +296,6 @@ async def admin_stats(request: Request):
     if not verify_admin_api_key(request):
         return Response(status_code=403, content="Forbidden")
     
-    from bot.db.repositories import StatsRepository
-    
     session_maker = get_session_maker()
     
     async with session_maker() as session:
@@ -217,11 +316,8 @@ async def admin_queue_stats(request: Request):
         return Response(status_code=403, content="Forbidden")
     
     try:
-        from redis import Redis
-        from rq import Queue
-        
-        redis_conn = Redis.from_url(config.redis_url)
-        queue = Queue(connection=redis_conn)
+        # Shared queue (and Redis connection pool) from the task module
+        queue = get_queue()
         
         return {
             "queue_name": queue.name,
@@ -244,8 +340,6 @@ async def admin_get_user(request: Request, telegram_id: int):
     if not verify_admin_api_key(request):
         return Response(status_code=403, content="Forbidden")
     
-    from bot.db.repositories import UserRepository, TaskRepository
-    
     session_maker = get_session_maker()
     
     async with session_maker() as session:
@@ -256,7 +350,7 @@ async def admin_get_user(request: Request, telegram_id: int):
             return Response(status_code=404, content="User not found")
         
         task_repo = TaskRepository(session)
-        history = await task_repo.get_user_history(user.id, limit=100)
+        counts = await task_repo.count_by_status(user.id)
         
         return {
             "id": user.id,
@@ -268,9 +362,9 @@ async def admin_get_user(request: Request, telegram_id: int):
             "image_quality": user.image_quality,
             "image_size": user.image_size,
             "created_at": user.created_at.isoformat() if user.created_at else None,
-            "tasks_count": len(history),
-            "tasks_done": sum(1 for t in history if t.status == "done"),
-            "tasks_failed": sum(1 for t in history if t.status == "failed"),
+            "tasks_count": sum(counts.values()),
+            "tasks_done": counts.get("done", 0),
+            "tasks_failed": counts.get("failed", 0),
         }
 
 
@@ -286,16 +380,13 @@ async def admin_add_tokens(request: Request, telegram_id: int):
         return Response(status_code=403, content="Forbidden")
     
     try:
-        body = await request.json()
-        amount = int(body.get("amount", 0))
-    except (ValueError, TypeError):
+        amount = AddTokensRequest.model_validate_json(await request.body()).amount
+    except ValidationError:
         return Response(status_code=400, content="Invalid amount")
     
     if amount <= 0:
         return Response(status_code=400, content="Amount must be positive")
     
-    from bot.db.repositories import UserRepository
-    
     session_maker = get_session_maker()
     
     async with session_maker() as session:
@@ -0,0 +1,7 @@
+# Aiogram middlewares
+
+from bot.middlewares.db import DbSessionMiddleware
+
+__all__ = [
+    "DbSessionMiddleware",
+]
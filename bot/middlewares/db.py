@@ -0,0 +1,34 @@
+"""Middleware that provides a database session to handlers."""
+
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from bot.db.database import get_session_maker
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Open one AsyncSession per event and pass it to the handler as `session`.
+
+    The session is committed after the handler returns and rolled back if
+    it raises. Register it as an inner middleware so sessions are only
+    opened for events that matched a handler.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with get_session_maker()() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
@@ -2,10 +2,11 @@
 
 from typing import Optional
 
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.db.models import User, GenerationTask
+from bot.db.user_cache import invalidate_user
 
 
 class InsufficientBalanceError(Exception):
@@ -51,6 +52,7 @@ class BalanceService:
         user_id: int,
         amount: int,
         raise_on_insufficient: bool = True,
+        commit: bool = True,
     ) -> Optional[User]:
         """
         Deduct tokens from user's balance.
@@ -59,6 +61,8 @@ class BalanceService:
             user_id: User's database ID
             amount: Number of tokens to deduct
             raise_on_insufficient: If True, raise InsufficientBalanceError
+            commit: If False, leave the transaction open for the caller
+                (the caller is then responsible for cache invalidation)
         
         Returns:
             Updated user or None if not found
@@ -66,24 +70,75 @@ class BalanceService:
         Raises:
             InsufficientBalanceError: If user doesn't have enough tokens
         """
+        # Conditional decrement: the row is only updated if the balance
+        # covers the amount, so concurrent spends cannot overdraw it.
         result = await self.session.execute(
-            select(User).where(User.id == user_id)
+            update(User)
+            .where(User.id == user_id, User.tokens >= amount)
+            .values(tokens=User.tokens - amount)
+            .returning(User)
         )
         user = result.scalar_one_or_none()
         
         if user is None:
+            result = await self.session.execute(
+                select(User.tokens).where(User.id == user_id)
+            )
+            available = result.scalar_one_or_none()
+            
+            if available is None:
+                return None
+            
+            if raise_on_insufficient:
+                raise InsufficientBalanceError(required=amount, available=available)
             return None
         
-        if user.tokens < amount:
-            if raise_on_insufficient:
-                raise InsufficientBalanceError(required=amount, available=user.tokens)
+        if commit:
+            await self.session.commit()
+            await invalidate_user(user.telegram_id)
+        
+        return user
+    
+    async def deduct_and_create_task(
+        self,
+        user_id: int,
+        amount: int,
+        **task_fields,
+    ) -> Optional[GenerationTask]:
+        """
+        Charge the user and create the generation task in one transaction.
+        
+        Either both the deduction and the task insert are committed, or
+        neither is.
+        
+        Args:
+            user_id: User's database ID
+            amount: Number of tokens to deduct (recorded as tokens_spent)
+            **task_fields: Remaining TaskRepository.create() arguments
+        
+        Returns:
+            Created task or None if user not found
+        
+        Raises:
+            InsufficientBalanceError: If user doesn't have enough tokens
+        """
+        # Imported here: bot.db.repositories -> bot.services -> this module
+        from bot.db.repositories import TaskRepository
+        
+        user = await self.deduct_tokens(user_id, amount, commit=False)
+        if user is None:
             return None
         
-        user.tokens -= amount
+        task = await TaskRepository(self.session).create(
+            user_id=user_id,
+            tokens_spent=amount,
+            commit=False,
+            **task_fields,
+        )
         await self.session.commit()
-        await self.session.refresh(user)
+        await invalidate_user(user.telegram_id)
         
-        return user
+        return task
     
     async def refund_tokens(self, user_id: int, amount: int) -> Optional[User]:
         """
@@ -97,16 +152,18 @@ class BalanceService:
             Updated user or None if not found
         """
         result = await self.session.execute(
-            select(User).where(User.id == user_id)
+            update(User)
+            .where(User.id == user_id)
+            .values(tokens=User.tokens + amount)
+            .returning(User)
         )
         user = result.scalar_one_or_none()
+        await self.session.commit()
         
         if user is None:
             return None
         
-        user.tokens += amount
-        await self.session.commit()
-        await self.session.refresh(user)
+        await invalidate_user(user.telegram_id)
         
         return user
     
@@ -1,22 +1,86 @@
 """Image provider service for AI image generation."""
 
 import base64
+import io
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Optional
 
+import httpx
+from aiogram import Bot
 from openai import AsyncOpenAI
 
+from bot.bot import get_bot
+from bot.config import config
+
 logger = logging.getLogger(__name__)
 
+# Shared HTTP client for source image downloads (created lazily, inside the
+# running loop) so repeated edits reuse keep-alive connections
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Get or create the shared download client."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=30,
+        )
+    return _http_client
+
+
+# One OpenAI client per API key, shared by all providers, so tasks reuse
+# its keep-alive connection pool instead of a TLS handshake per client
+_openai_clients: dict[str, AsyncOpenAI] = {}
+
+
+def _get_openai_client(api_key: str) -> AsyncOpenAI:
+    """Get or create the shared OpenAI client for api_key."""
+    client = _openai_clients.get(api_key)
+    if client is None:
+        timeout = httpx.Timeout(config.openai_timeout_seconds, connect=10)
+        client = _openai_clients[api_key] = AsyncOpenAI(
+            api_key=api_key,
+            timeout=timeout,
+            # RQ retries the whole task with backoff; don't retry twice
+            max_retries=0,
+            # Explicit pool bounds instead of the SDK defaults
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+                timeout=timeout,
+                follow_redirects=True,
+            ),
+        )
+    return client
+
+
+async def close_http_client() -> None:
+    """
+    Close the shared download and OpenAI clients.
+    
+    AsyncOpenAI.close() closes the httpx client it was built with, so this
+    releases both bounded connection pools.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    
+    for client in _openai_clients.values():
+        await client.close()
+    _openai_clients.clear()
+
 
-@dataclass
+@dataclass(slots=True)
 class GenerationResult:
     """Result of an image generation/edit operation."""
     
     success: bool
-    image_base64: Optional[str] = None
+    # Image bytes: decoded from b64_json or prefetched from image_url
+    image_bytes: Optional[bytes] = None
     image_url: Optional[str] = None
     error: Optional[str] = None
 
@@ -64,7 +128,7 @@ class OpenAIImageProvider(ImageProvider):
     def __init__(self, api_key: str, model: str = DEFAULT_MODEL):
         self.api_key = api_key
         self.model = model
-        self.client = AsyncOpenAI(api_key=api_key)
+        self.client = _get_openai_client(api_key)
     
     async def generate(
         self,
@@ -98,15 +162,12 @@ class OpenAIImageProvider(ImageProvider):
                 logger.info(f"Image generated successfully (base64)")
                 return GenerationResult(
                     success=True,
-                    image_base64=image_data.b64_json,
+                    image_bytes=base64.b64decode(image_data.b64_json),
                 )
             # DALL-E models may return URL
             elif hasattr(image_data, 'url') and image_data.url:
                 logger.info(f"Image generated successfully (URL)")
-                return GenerationResult(
-                    success=True,
-                    image_url=image_data.url,
-                )
+                return await self._url_result(image_data.url)
             else:
                 logger.error(f"OpenAI returned empty response. Data: {image_data}")
                 return GenerationResult(
@@ -122,6 +183,65 @@ class OpenAIImageProvider(ImageProvider):
                 error=error_msg,
             )
     
+    async def _url_result(self, url: str) -> GenerationResult:
+        """
+        Result for an image returned by URL, with its bytes prefetched.
+        
+        Result URLs expire, and Telegram fetching one late would fail the
+        send after the generation was already paid for. Keeps just the URL
+        if the download fails.
+        """
+        try:
+            response = await _get_http_client().get(url)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to prefetch result image, sending URL: {e}")
+            return GenerationResult(success=True, image_url=url)
+        
+        return GenerationResult(
+            success=True,
+            image_bytes=response.content,
+            image_url=url,
+        )
+    
+    async def _download_url(self, url: str) -> tuple[io.BytesIO, int]:
+        """Download an edit source image by URL."""
+        img_response = await _get_http_client().get(url)
+        img_response.raise_for_status()
+        # BytesIO shares the bytes object until written to, no copy
+        return io.BytesIO(img_response.content), len(img_response.content)
+    
+    async def _download_telegram_file(
+        self,
+        file_id: str,
+        bot_token: Optional[str],
+    ) -> tuple[io.BytesIO, int]:
+        """Download an edit source image by Telegram file_id."""
+        if not bot_token:
+            raise ValueError("bot_token required for Telegram file_id")
+        
+        # Reuse the shared bot (and its pooled session) for our own
+        # token; a foreign token gets a throwaway instance
+        shared = bot_token == config.bot_token
+        bot = get_bot() if shared else Bot(token=bot_token)
+        
+        try:
+            # Get file info
+            file = await bot.get_file(file_id)
+            
+            # Download file to memory; the buffer is rewound and
+            # handed to OpenAI as is, without a getvalue() copy
+            image_file = io.BytesIO()
+            await bot.download_file(file.file_path, image_file, seek=False)
+            image_size = image_file.tell()
+            image_file.seek(0)
+        finally:
+            if not shared:
+                await bot.session.close()
+        
+        logger.info(f"Downloaded image from Telegram: {image_size} bytes")
+        return image_file, image_size
+    
     async def edit(
         self,
         image_source: str,
@@ -140,45 +260,17 @@ class OpenAIImageProvider(ImageProvider):
         logger.info(f"Editing image with model {use_model}, prompt: {prompt[:100]}...")
         
         try:
-            import httpx
-            import io
-            
-            image_bytes: bytes
-            
             # Check if image_source is a URL or Telegram file_id
             if image_source.startswith(('http://', 'https://')):
-                # It's a URL - download directly
-                async with httpx.AsyncClient() as http_client:
-                    img_response = await http_client.get(image_source)
-                    img_response.raise_for_status()
-                    image_bytes = img_response.content
+                image_file, image_size = await self._download_url(image_source)
             else:
-                # It's a Telegram file_id - download from Telegram
-                if not bot_token:
-                    raise ValueError("bot_token required for Telegram file_id")
-                
-                from aiogram import Bot
-                
-                bot = Bot(token=bot_token)
-                
-                try:
-                    # Get file info
-                    file = await bot.get_file(image_source)
-                    
-                    # Download file to memory
-                    file_buffer = io.BytesIO()
-                    await bot.download_file(file.file_path, file_buffer)
-                    image_bytes = file_buffer.getvalue()
-                    
-                    logger.info(f"Downloaded image from Telegram: {len(image_bytes)} bytes")
-                finally:
-                    await bot.session.close()
+                image_file, image_size = await self._download_telegram_file(
+                    image_source, bot_token
+                )
             
-            # Create file-like object for OpenAI API
-            image_file = io.BytesIO(image_bytes)
             image_file.name = "image.png"  # OpenAI needs a filename
             
-            logger.info(f"Sending to OpenAI edit endpoint, size: {len(image_bytes)} bytes")
+            logger.info(f"Sending to OpenAI edit endpoint, size: {image_size} bytes")
             
             # Use OpenAI edit endpoint
             response = await self.client.images.edit(
@@ -197,15 +289,12 @@ class OpenAIImageProvider(ImageProvider):
                 logger.info(f"Image edited successfully (base64)")
                 return GenerationResult(
                     success=True,
-                    image_base64=image_data.b64_json,
+                    image_bytes=base64.b64decode(image_data.b64_json),
                 )
             # DALL-E 2 may return URL
             elif hasattr(image_data, 'url') and image_data.url:
                 logger.info(f"Image edited successfully (URL)")
-                return GenerationResult(
-                    success=True,
-                    image_url=image_data.url,
-                )
+                return await self._url_result(image_data.url)
             else:
                 logger.error(f"OpenAI edit returned empty response")
                 return GenerationResult(
@@ -56,6 +56,10 @@ IMAGE_QUALITY_LABELS: dict[ImageQuality, str] = {
 }
 
 
+_VALID_QUALITIES: frozenset[str] = frozenset(IMAGE_TOKEN_TABLE)
+_VALID_SIZES: frozenset[str] = frozenset(IMAGE_SIZE_LABELS)
+
+
 def estimate_image_tokens(quality: ImageQuality, size: ImageSize) -> int:
     """Return the expected image token cost for the given parameters."""
 
@@ -65,10 +69,10 @@ def estimate_image_tokens(quality: ImageQuality, size: ImageSize) -> int:
 def is_valid_quality(value: str) -> bool:
     """Validate image quality string."""
 
-    return value in ("low", "medium", "high")
+    return value in _VALID_QUALITIES
 
 
 def is_valid_size(value: str) -> bool:
     """Validate image size string."""
 
-    return value in ("1024x1024", "1024x1536", "1536x1024")
+    return value in _VALID_SIZES
@@ -0,0 +1,75 @@
+"""Redis-backed throttle for OpenAI image requests shared by all workers.
+
+Workers take a slot in the current one-minute window before calling the
+Images API. When the window is full they sleep until the next one instead
+of firing a request that would come back as 429 and burn an RQ retry.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from bot.bot import get_redis_pool
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+_WINDOW_SECONDS = 60
+
+_redis: Optional[Redis] = None
+
+
+def _get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis(connection_pool=get_redis_pool())
+    return _redis
+
+
+async def acquire_openai_slot(max_wait: float) -> bool:
+    """
+    Wait until an OpenAI request fits into OPENAI_REQUESTS_PER_MINUTE.
+
+    No-op when the limit is 0. Fails open if Redis is unavailable: the
+    request goes ahead and a 429 is handled by the normal retry path.
+
+    Args:
+        max_wait: Give up instead of sleeping past this many seconds
+
+    Returns:
+        True if the request may go ahead, False if no slot frees up
+        within max_wait
+    """
+    limit = config.openai_requests_per_minute
+    if limit <= 0:
+        return True
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        now = time.time()
+        window = int(now // _WINDOW_SECONDS)
+        key = f"openai:rpm:{window}"
+
+        try:
+            async with _get_redis().pipeline(transaction=True) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, _WINDOW_SECONDS * 2)
+                count, _ = await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"OpenAI throttle unavailable, not waiting: {e}")
+            return True
+
+        if count <= limit:
+            return True
+
+        # Spread waiters over the first second of the next window
+        delay = (window + 1) * _WINDOW_SECONDS - now + random.uniform(0, 1)
+        if time.monotonic() + delay > deadline:
+            return False
+        logger.info(f"OpenAI request limit reached, waiting {delay:.1f}s")
+        await asyncio.sleep(delay)
@@ -8,16 +8,21 @@ import logging
 from dataclasses import dataclass
 from typing import Optional
 
+from bot.config import config
 from bot.db.database import get_session_maker
 from bot.db.repositories import UserRepository, TaskRepository
 from bot.db.models import GenerationTask
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import estimate_image_tokens
+from bot.tasks.generation import enqueue_in_background
 
 logger = logging.getLogger(__name__)
 
+# Config is frozen, so the limit (and its message) is fixed at import
+_RATE_LIMIT_ERROR = f"Превышен лимит: {config.max_tasks_per_user_per_hour} задач в час"
 
-@dataclass
+
+@dataclass(slots=True)
 class TaskCreationResult:
     """Result of task creation attempt."""
     
@@ -91,8 +96,7 @@ async def create_and_enqueue_task(
         user_repo = UserRepository(session)
         
         # Verify user exists
-        user = await user_repo.get_by_telegram_id(telegram_id)
-        if user is None:
+        if await user_repo.get_tokens(telegram_id) is None:
             return TaskCreationResult(
                 success=False,
                 error_type="user_not_found",
@@ -100,7 +104,6 @@ async def create_and_enqueue_task(
             )
         
         # Check rate limiting
-        from bot.config import config
         recent_tasks = await task_repo.count_user_tasks_since(
             user_id=user_id,
             hours=1,
@@ -109,24 +112,27 @@ async def create_and_enqueue_task(
             return TaskCreationResult(
                 success=False,
                 error_type="rate_limit",
-                error_message=f"Превышен лимит: {config.max_tasks_per_user_per_hour} задач в час",
+                error_message=_RATE_LIMIT_ERROR,
             )
         
         try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-            
-            # Create task
-            task = await task_repo.create(
-                user_id=user_id,
+            # Conditional deduct + task insert, committed together
+            task = await balance_service.deduct_and_create_task(
+                user_id,
+                cost,
                 task_type=task_type,
                 prompt=prompt,
-                tokens_spent=cost,
                 model=model,
                 image_quality=quality,
                 image_size=size,
                 source_image_url=source_image_url,
             )
+            if task is None:
+                return TaskCreationResult(
+                    success=False,
+                    error_type="user_not_found",
+                    error_message="Пользователь не найден",
+                )
             
             logger.info(f"Created {task_type} task {task.id} for user {user_id}")
             
@@ -139,13 +145,8 @@ async def create_and_enqueue_task(
                 available_tokens=e.available,
             )
     
-    # Enqueue task to RQ (outside of DB session)
-    try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
-    except Exception as e:
-        logger.error(f"Failed to enqueue task {task.id}: {e}")
-        # Task is created, worker will pick it up eventually
+    # Enqueue task to RQ in the background (outside of DB session)
+    enqueue_in_background(task.id)
     
     return TaskCreationResult(
         success=True,
@@ -6,36 +6,94 @@ image generation/editing requests asynchronously.
 
 import asyncio
 import logging
+import random
+from datetime import timedelta
 from typing import Optional
 
-from redis import Redis
+from aiogram.types import BufferedInputFile
+from redis import ConnectionPool, Redis
 from rq import Queue, Retry
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from bot.bot import close_bot, close_redis_pool, get_bot
 from bot.config import config
-from bot.db.database import get_session_maker
+from bot.db.database import close_db, get_session_maker
+from bot.db.user_cache import close_user_cache
 from bot.db.models import GenerationTask
 from bot.db.repositories import TaskRepository
 from bot.services.balance import BalanceService
-from bot.services.image_provider import OpenAIImageProvider, GenerationResult
+from bot.services.image_provider import (
+    GenerationResult,
+    OpenAIImageProvider,
+    close_http_client,
+)
+from bot.services.ratelimit import acquire_openai_slot
+from bot.utils.helpers import escape_prompt_preview
 
 logger = logging.getLogger(__name__)
 
 # Maximum retry attempts (handled by RQ, but we track in DB too)
 MAX_RETRIES = 3
+# First retry delay in seconds; doubles per attempt
+_RETRY_BASE_DELAY = 10
+
+# Longest wait for a slot under OPENAI_REQUESTS_PER_MINUTE: one window
+_THROTTLE_MAX_WAIT = 65
+# Slack on top of the OpenAI request timeout for source downloads etc.
+_PROVIDER_TIMEOUT_MARGIN = 30
+# RQ kills jobs after 180s by default, before our own timeouts could fire
+# and run the retry/refund branch. Every step of a job is bounded: the
+# throttle wait, the provider call, one Telegram request (session
+# timeout), plus slack for the DB writes.
+_JOB_TIMEOUT = int(
+    _THROTTLE_MAX_WAIT
+    + config.openai_timeout_seconds
+    + _PROVIDER_TIMEOUT_MARGIN
+    + config.telegram_request_timeout
+    + 30
+)
+
+# Sync Redis pool for RQ, shared by the queue and the worker. Bounded, so
+# enqueue bursts from handler threads reuse sockets instead of opening more
+_REDIS_MAX_CONNECTIONS = 64
+_redis_pool: Optional[ConnectionPool] = None
 
 # RQ Queue instance (lazy initialization)
 _queue: Optional[Queue] = None
 
 
+def get_redis_connection() -> Redis:
+    """Get a sync Redis client backed by the shared RQ connection pool."""
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = ConnectionPool.from_url(
+            config.redis_url,
+            max_connections=_REDIS_MAX_CONNECTIONS,
+            socket_keepalive=True,
+        )
+    return Redis(connection_pool=_redis_pool)
+
+
 def get_queue() -> Queue:
     """Get or create the RQ queue instance."""
     global _queue
     if _queue is None:
-        redis_conn = Redis.from_url(config.redis_url)
-        _queue = Queue(connection=redis_conn)
+        _queue = Queue(connection=get_redis_connection())
     return _queue
 
 
+def _retry_intervals() -> list[int]:
+    """
+    Retry delays for one job: exponential from _RETRY_BASE_DELAY seconds,
+    each with up to _RETRY_BASE_DELAY of random jitter so tasks that failed
+    together (e.g. a provider outage) don't all retry at the same moment.
+    """
+    return [
+        int(_RETRY_BASE_DELAY * 2**attempt + random.uniform(0, _RETRY_BASE_DELAY))
+        for attempt in range(MAX_RETRIES)
+    ]
+
+
 def enqueue_generation_task(task_id: int) -> None:
     """
     Enqueue a generation task to RQ.
@@ -45,16 +103,116 @@ def enqueue_generation_task(task_id: int) -> None:
     """
     queue = get_queue()
     
-    # Enqueue with retry policy: 3 attempts with exponential backoff
+    # Enqueue with retry policy: 3 attempts with jittered exponential backoff
     job = queue.enqueue(
         process_generation_task,
         task_id,
-        retry=Retry(max=MAX_RETRIES, interval=[10, 30, 60]),
+        retry=Retry(max=MAX_RETRIES, interval=_retry_intervals()),
+        job_timeout=_JOB_TIMEOUT,
+        on_failure=_on_job_failure,
     )
     
     logger.info(f"Enqueued task {task_id} as job {job.id}")
 
 
+# Strong references to in-flight enqueues so they aren't garbage collected
+_background_enqueues: set[asyncio.Task] = set()
+
+
+async def _enqueue_and_log(task_id: int) -> None:
+    try:
+        await asyncio.to_thread(enqueue_generation_task, task_id)
+    except Exception as e:
+        # Task is created, worker will pick it up eventually
+        logger.error(f"Failed to enqueue task {task_id}: {e}")
+
+
+def enqueue_in_background(task_id: int) -> None:
+    """
+    Enqueue a generation task without blocking the event loop.
+    
+    RQ's enqueue is a synchronous Redis call, so it runs in a worker thread
+    while the handler goes on to answer the user. Must be called from a
+    running event loop.
+    
+    Args:
+        task_id: Database ID of the GenerationTask
+    """
+    bg_task = asyncio.create_task(_enqueue_and_log(task_id))
+    _background_enqueues.add(bg_task)
+    bg_task.add_done_callback(_background_enqueues.discard)
+
+
+# Provider for the job running in this process. It holds the shared OpenAI
+# client, so it is dropped with the loop in close_loop(). The task's model
+# is passed per call, so the provider's default model is only a fallback.
+_image_provider: Optional[OpenAIImageProvider] = None
+
+
+def _get_image_provider() -> OpenAIImageProvider:
+    """Get or create the worker's image provider."""
+    global _image_provider
+    if _image_provider is None:
+        _image_provider = OpenAIImageProvider(api_key=config.openai_api_key)
+    return _image_provider
+
+
+# Event loop owned by the current job. worker.py forks a work horse per
+# job, so the loop and the clients bound to it (DB engine, aiohttp/httpx
+# sessions) live for one job and are closed before the horse exits. The
+# failure callback may also run in the worker's main process, where
+# closing them keeps a live loop and open sockets out of the next fork.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Get or create the current job's event loop."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+async def _close_clients() -> None:
+    await close_bot()
+    await close_db()
+    await close_user_cache()
+    await close_redis_pool()
+    await close_http_client()
+
+
+def close_loop() -> None:
+    """Close the job's clients and its event loop."""
+    global _loop, _image_provider
+    if _loop is None or _loop.is_closed():
+        return
+    try:
+        _loop.run_until_complete(_close_clients())
+        _loop.run_until_complete(_loop.shutdown_asyncgens())
+    finally:
+        _loop.close()
+        _loop = None
+        _image_provider = None
+
+
+def _run_job(coro):
+    """Run coro on the job's loop, then close the loop and its clients."""
+    loop = _get_loop()
+    job = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(job)
+    finally:
+        try:
+            if not job.done():
+                # Interrupted from outside the loop (RQ's job timeout
+                # signal): cancel the job before its clients are closed
+                job.cancel()
+                loop.run_until_complete(asyncio.gather(job, return_exceptions=True))
+        finally:
+            close_loop()
+
+
 def process_generation_task(task_id: int) -> bool:
     """
     Process a generation task.
@@ -76,9 +234,7 @@ def process_generation_task(task_id: int) -> bool:
         Exception: Re-raised for RQ retry mechanism
     """
     # Run async code in sync context (RQ workers are sync)
-    return asyncio.get_event_loop().run_until_complete(
-        _process_generation_task_async(task_id)
-    )
+    return _run_job(_process_generation_task_async(task_id))
 
 
 async def _process_generation_task_async(task_id: int) -> bool:
@@ -97,29 +253,34 @@ async def _process_generation_task_async(task_id: int) -> bool:
     
     async with session_maker() as session:
         task_repo = TaskRepository(session)
-        balance_service = BalanceService(session)
         
-        # Get task from database
-        task = await task_repo.get_by_id(task_id)
-        if task is None:
-            logger.error(f"Task {task_id} not found")
+        # Mark as processing and load the task together with the recipient
+        # for the result/failure message in one UPDATE ... RETURNING
+        # ("processing" is shown to users in their history)
+        # Only a pending task is claimed, so a duplicate job can't call
+        # OpenAI and send the result twice. A job cut short is settled by
+        # _on_job_failure; a task still stuck past the job timeout (e.g.
+        # the callback never ran) is reclaimed as stale.
+        started = await task_repo.start_processing(
+            task_id, stale_after=timedelta(seconds=_JOB_TIMEOUT)
+        )
+        if started is None:
+            logger.info(f"Task {task_id} not found or already claimed, skipping")
             return False
-        
-        # Update status to processing
-        await task_repo.update_status(task_id, status="processing")
+        task, telegram_id = started
         logger.info(f"Task {task_id} status updated to processing")
         
         try:
-            # Initialize image provider with task model
-            image_provider = OpenAIImageProvider(
-                api_key=config.openai_api_key,
-                model=task.model or "gpt-image-1",
-            )
+            image_provider = _get_image_provider()
+            
+            # Wait for a slot under the shared OpenAI request limit
+            if not await acquire_openai_slot(max_wait=_THROTTLE_MAX_WAIT):
+                raise GenerationError("OpenAI request limit reached")
             
             # Generate or edit based on task type
             result: GenerationResult
             if task.task_type == "generate":
-                result = await image_provider.generate(
+                provider_call = image_provider.generate(
                     task.prompt,
                     model=task.model,
                     quality=task.image_quality,
@@ -129,7 +290,7 @@ async def _process_generation_task_async(task_id: int) -> bool:
                 if task.source_image_url is None:
                     raise ValueError("Edit task requires source_image_url")
                 # Pass bot token for Telegram file download
-                result = await image_provider.edit(
+                provider_call = image_provider.edit(
                     task.source_image_url,
                     task.prompt,
                     bot_token=config.bot_token,
@@ -140,25 +301,46 @@ async def _process_generation_task_async(task_id: int) -> bool:
             else:
                 raise ValueError(f"Unknown task type: {task.task_type}")
             
-            if result.success and (result.image_url or result.image_base64):
+            # Cap the whole provider call (downloads included) so a stuck
+            # request fails into the retry branch instead of hanging the job
+            try:
+                result = await asyncio.wait_for(
+                    provider_call,
+                    timeout=config.openai_timeout_seconds + _PROVIDER_TIMEOUT_MARGIN,
+                )
+            except asyncio.TimeoutError:
+                raise GenerationError("timeout")
+            
+            if result.success and (result.image_url or result.image_bytes):
                 # Send result to user via Telegram
                 file_id = await _send_result_to_user(
                     task,
-                    result.image_url or result.image_base64 or "",
-                    is_base64=result.image_base64 is not None and result.image_url is None,
+                    telegram_id,
+                    result.image_bytes or result.image_url,
                 )
 
                 if not file_id:
                     raise GenerationError("Failed to send result to user")
 
-                # Success - update task with result
-                await task_repo.update_status(
-                    task_id,
-                    status="done",
-                    result_image_url=result.image_url,
-                    result_file_id=file_id,
-                )
-                logger.info(f"Task {task_id} completed successfully")
+                # The user already has the image from here on: a failed
+                # bookkeeping write must not fall into the retry/refund
+                # branch, which would generate, send and refund again
+                try:
+                    done = await task_repo.update_status(
+                        task_id,
+                        status="done",
+                        result_image_url=result.image_url,
+                        result_file_id=file_id,
+                        expected_status="processing",
+                    )
+                except Exception as e:
+                    logger.error(f"Task {task_id} delivered but not marked done: {e}")
+                    return True
+                
+                if done is None:
+                    logger.warning(f"Task {task_id} was no longer processing when done")
+                else:
+                    logger.info(f"Task {task_id} completed successfully")
                 
                 return True
             else:
@@ -172,45 +354,98 @@ async def _process_generation_task_async(task_id: int) -> bool:
             error_msg = str(e)
             logger.error(f"Task {task_id} failed with error: {error_msg}")
             
-            # Refresh task to get current retry count
-            task = await task_repo.get_by_id(task_id)
+            task = await _record_failed_attempt(session, task_id, error_msg)
             if task is None:
+                # Gone, or no longer ours: another job settled it
                 return False
             
-            current_retry = task.retry_count + 1
-            
-            if current_retry >= MAX_RETRIES:
-                # All retries exhausted - mark as failed and refund
-                await task_repo.update_status(
-                    task_id,
-                    status="failed",
-                    error_message=error_msg,
-                    increment_retry=True,
-                )
-                
-                # Refund tokens
-                await balance_service.refund_task(task_id)
-                logger.info(f"Task {task_id} marked as failed, tokens refunded")
-                
-                # Notify user about failure
-                await _send_failure_notification(task, error_msg)
-                
+            if task.status == "failed":
                 return False
             else:
-                # Increment retry count and re-raise for RQ retry
-                await task_repo.update_status(
-                    task_id,
-                    status="pending",
-                    error_message=error_msg,
-                    increment_retry=True,
-                )
                 logger.info(
-                    f"Task {task_id} retry {current_retry}/{MAX_RETRIES}, "
+                    f"Task {task_id} retry {task.retry_count}/{MAX_RETRIES}, "
                     f"re-queuing..."
                 )
                 raise  # Re-raise for RQ retry mechanism
 
 
+_CAPTION_DETAILS = (
+    "Промпт: {prompt}\n\n"
+    "Качество: {quality}\n"
+    "Формат: {size}\n"
+    "Списано: {tokens} 🪙"
+)
+_CAPTION_GENERATE = "✅ Картинка создана!\n\n" + _CAPTION_DETAILS
+_CAPTION_EDIT = "✅ Фото отредактировано!\n\n" + _CAPTION_DETAILS
+
+_FAILURE_MESSAGE = (
+    "❌ К сожалению, генерация не удалась.\n\n"
+    "Токены ({tokens}) возвращены на ваш баланс.\n\n"
+    "Попробуйте ещё раз или измените промпт."
+)
+
+
+def _build_result_caption(task: GenerationTask) -> str:
+    """Caption for the result document (HTML, like every bot message)."""
+    template = _CAPTION_GENERATE if task.task_type == "generate" else _CAPTION_EDIT
+    return template.format(
+        prompt=escape_prompt_preview(task.prompt, max_length=200),
+        quality=task.image_quality,
+        size=task.image_size,
+        tokens=task.tokens_spent,
+    )
+
+
+async def _record_failed_attempt(
+    session: AsyncSession,
+    task_id: int,
+    error_msg: str,
+) -> Optional[GenerationTask]:
+    """
+    Count a failed attempt; refund and notify the user once retries run out.
+    
+    Returns:
+        The updated task, or None if it wasn't processing (already settled)
+    """
+    # The same UPDATE decides failed vs pending
+    failed = await TaskRepository(session).record_failure(task_id, error_msg, MAX_RETRIES)
+    if failed is None:
+        return None
+    task, telegram_id = failed
+    
+    if task.status == "failed":
+        # All retries exhausted - refund (no need to re-read the task)
+        await BalanceService(session).refund_tokens(task.user_id, task.tokens_spent)
+        logger.info(f"Task {task_id} marked as failed, tokens refunded")
+        
+        # Notify user about failure
+        await _send_failure_notification(task, telegram_id, error_msg)
+    
+    return task
+
+
+def _on_job_failure(job, connection, exc_type, exc_value, traceback) -> None:
+    """
+    RQ failure callback: settle a task whose job was cut short.
+    
+    Ordinary errors are recorded by the job itself, which leaves the task
+    pending or failed, so this is a no-op for them. When RQ's job timeout
+    or a dead worker ended the job, the task is still "processing": count
+    the attempt here so the RQ retry can claim it again, or refund once
+    retries are used up.
+    """
+    task_id = job.args[0]
+    error_msg = str(exc_value) or exc_type.__name__
+    _run_job(_settle_interrupted_task(task_id, error_msg))
+
+
+async def _settle_interrupted_task(task_id: int, error_msg: str) -> None:
+    async with get_session_maker()() as session:
+        task = await _record_failed_attempt(session, task_id, error_msg)
+    if task is not None:
+        logger.warning(f"Task {task_id} was interrupted ({error_msg}), attempt recorded")
+
+
 class GenerationError(Exception):
     """Custom exception for generation failures."""
     pass
@@ -218,57 +453,31 @@ class GenerationError(Exception):
 
 async def _send_result_to_user(
     task: GenerationTask,
-    image_data: str,
-    is_base64: bool = False,
+    telegram_id: Optional[int],
+    image_data: str | bytes,
 ) -> Optional[str]:
     """
     Send generated image to user via Telegram.
     
     Args:
         task: GenerationTask with user info
-        image_data: URL of the generated image or base64 string
-        is_base64: Whether image_data is base64 encoded
+        telegram_id: Recipient's Telegram ID (None if the user is gone)
+        image_data: Image bytes, or its URL if they couldn't be fetched
     """
     try:
-        from aiogram import Bot
-        from aiogram.types import BufferedInputFile
-        import base64
-        import re
+        if telegram_id is None:
+            logger.error(f"User {task.user_id} not found for task {task.id}")
+            return None
         
-        bot = Bot(token=config.bot_token)
-        
-        # Get user's telegram_id from task's user relationship
-        session_maker = get_session_maker()
-        async with session_maker() as session:
-            from sqlalchemy import select
-            from bot.db.models import User
-            
-            result = await session.execute(
-                select(User.telegram_id).where(User.id == task.user_id)
-            )
-            telegram_id = result.scalar_one_or_none()
-            
-            if telegram_id is None:
-                logger.error(f"User {task.user_id} not found for task {task.id}")
-                return None
+        # Shared per-process bot: keeps a warm keep-alive pool to Telegram
+        bot = get_bot()
         
         # Send image to user
-        task_type_text = "Картинка создана" if task.task_type == "generate" else "Фото отредактировано"
-        prompt_preview = task.prompt[:200] + "..." if len(task.prompt) > 200 else task.prompt
-        caption = (
-            f"✅ {task_type_text}!\n\n"
-            f"Промпт: {prompt_preview}\n\n"
-            f"Качество: {task.image_quality}\n"
-            f"Формат: {task.image_size}\n"
-            f"Списано: {task.tokens_spent} 🪙"
-        )
-
-        filename_safe = re.sub(r"[^a-zA-Z0-9_\-]+", "_", f"task_{task.id}")
+        caption = _build_result_caption(task)
 
-        if is_base64:
-            # Decode base64 and send as document
-            image_bytes = base64.b64decode(image_data)
-            document = BufferedInputFile(image_bytes, filename=f"{filename_safe}.png")
+        if isinstance(image_data, bytes):
+            # Upload the bytes as document
+            document = BufferedInputFile(image_data, filename=f"task_{task.id}.png")
             sent = await bot.send_document(
                 chat_id=telegram_id,
                 document=document,
@@ -285,8 +494,6 @@ async def _send_result_to_user(
         file_id = sent.document.file_id if sent and sent.document else None
         
         logger.info(f"Result sent to user {telegram_id} for task {task.id}")
-        
-        await bot.session.close()
 
         return file_id
     
@@ -295,46 +502,33 @@ async def _send_result_to_user(
         return None
 
 
-async def _send_failure_notification(task: GenerationTask, error_msg: str) -> None:
+async def _send_failure_notification(
+    task: GenerationTask,
+    telegram_id: Optional[int],
+    error_msg: str,
+) -> None:
     """
     Send failure notification to user via Telegram.
     
     Args:
         task: GenerationTask with user info
+        telegram_id: Recipient's Telegram ID (None if the user is gone)
         error_msg: Error message to include
     """
     try:
-        from aiogram import Bot
+        if telegram_id is None:
+            logger.error(f"User {task.user_id} not found for task {task.id}")
+            return
         
-        bot = Bot(token=config.bot_token)
-        
-        # Get user's telegram_id
-        session_maker = get_session_maker()
-        async with session_maker() as session:
-            from sqlalchemy import select
-            from bot.db.models import User
-            
-            result = await session.execute(
-                select(User.telegram_id).where(User.id == task.user_id)
-            )
-            telegram_id = result.scalar_one_or_none()
-            
-            if telegram_id is None:
-                logger.error(f"User {task.user_id} not found for task {task.id}")
-                return
+        bot = get_bot()
         
         # Send failure notification
-        message = (
-            f"❌ К сожалению, генерация не удалась.\n\n"
-            f"Токены ({task.tokens_spent}) возвращены на ваш баланс.\n\n"
-            f"Попробуйте ещё раз или измените промпт."
+        await bot.send_message(
+            chat_id=telegram_id,
+            text=_FAILURE_MESSAGE.format(tokens=task.tokens_spent),
         )
         
-        await bot.send_message(chat_id=telegram_id, text=message)
-        
         logger.info(f"Failure notification sent to user {telegram_id} for task {task.id}")
-        
-        await bot.session.close()
     
     except Exception as e:
         logger.error(f"Failed to send failure notification: {e}")
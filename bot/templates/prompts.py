@@ -1,7 +1,8 @@
 """Predefined prompt templates for image generation."""
 
 from dataclasses import dataclass
-from typing import List, Optional
+from functools import cached_property
+from typing import Dict, List, Optional
 
 
 @dataclass
@@ -13,6 +14,13 @@ class PromptTemplate:
     description: str
     prompt: str
     tokens_cost: int = 1
+    
+    @cached_property
+    def prompt_preview(self) -> str:
+        """Prompt shortened for the confirmation screen."""
+        if len(self.prompt) > 300:
+            return self.prompt[:300] + "..."
+        return self.prompt
 
 
 # Hardcoded templates for "Ideas and Trends" section
@@ -49,6 +57,8 @@ TEMPLATES: List[PromptTemplate] = [
     ),
 ]
 
+_TEMPLATES_BY_ID: Dict[str, PromptTemplate] = {t.id: t for t in TEMPLATES}
+
 
 def get_template_by_id(template_id: str) -> Optional[PromptTemplate]:
     """
@@ -60,7 +70,7 @@ def get_template_by_id(template_id: str) -> Optional[PromptTemplate]:
     Returns:
         PromptTemplate if found, None otherwise
     """
-    return next((t for t in TEMPLATES if t.id == template_id), None)
+    return _TEMPLATES_BY_ID.get(template_id)
 
 
 def get_all_templates() -> List[PromptTemplate]:
@@ -9,6 +9,7 @@ from bot.utils.helpers import (
     format_history_item,
     format_history_list,
     format_prompt_preview,
+    escape_prompt_preview,
     format_balance_change,
     SUPPORTED_MIME_TYPES,
     SUPPORTED_EXTENSIONS,
@@ -31,6 +32,7 @@ __all__ = [
     # Text formatting
     "truncate_text",
     "format_prompt_preview",
+    "escape_prompt_preview",
     # History formatting
     "format_history_item",
     "format_history_list",
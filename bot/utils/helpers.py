@@ -4,6 +4,7 @@ Helper utility functions for the Telegram bot.
 Contains validation and formatting functions used across handlers.
 """
 
+import html
 from datetime import datetime
 from typing import Optional, List, Any
 
@@ -240,6 +241,28 @@ def format_prompt_preview(prompt: str, max_length: int = 500) -> str:
     return truncate_text(prompt, max_length)
 
 
+def escape_prompt_preview(prompt: str, max_length: int = 500) -> str:
+    """
+    Truncate a user prompt and escape it for an HTML message.
+    
+    Messages are sent with parse_mode=HTML, so a raw "<" or "&" in the
+    prompt would make Telegram reject the whole message.
+    
+    Args:
+        prompt: Full prompt text
+        max_length: Maximum length before truncation
+    
+    Returns:
+        Escaped prompt with ellipsis if truncated
+    
+    Examples:
+        >>> escape_prompt_preview("cat <b> & dog")
+        'cat &lt;b&gt; &amp; dog'
+    """
+    preview = html.escape(prompt[:max_length], quote=False)
+    return preview + "..." if len(prompt) > max_length else preview
+
+
 # =============================================================================
 # BALANCE FORMATTING
 # =============================================================================
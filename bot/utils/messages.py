@@ -66,16 +66,18 @@ GENERATE_CONFIRM = """
 Подтвердить генерацию?
 """
 
-GENERATE_TASK_CREATED = """
-✅ <b>Задача создана!</b>
-
-🆔 ID задачи: <code>{task_id}</code>
-
-⏳ Ваше изображение генерируется...
-Я отправлю результат, когда будет готово.
-
-Это может занять 10-30 секунд.
-"""
+# Shared by the generate, edit and template flows; {task_id} (and
+# {template_name}) are left for the handler to fill in
+_TASK_CREATED = (
+    "✅ <b>Задача создана!</b>\n\n"
+    "🆔 ID задачи: <code>{{task_id}}</code>\n"
+    "{details}\n"
+    "⏳ Ваше изображение {action}...\n"
+    "Я отправлю результат, когда будет готово.\n\n"
+    "Это может занять 10-30 секунд."
+)
+
+GENERATE_TASK_CREATED = _TASK_CREATED.format(details="", action="генерируется")
 
 GENERATE_CANCELLED = "❌ Генерация отменена.\n\nВыберите действие:"
 
@@ -121,16 +123,7 @@ EDIT_CONFIRM = """
 Подтвердить редактирование?
 """
 
-EDIT_TASK_CREATED = """
-✅ <b>Задача создана!</b>
-
-🆔 ID задачи: <code>{task_id}</code>
-
-⏳ Ваше изображение редактируется...
-Я отправлю результат, когда будет готово.
-
-Это может занять 10-30 секунд.
-"""
+EDIT_TASK_CREATED = _TASK_CREATED.format(details="", action="редактируется")
 
 EDIT_CANCELLED = "❌ Редактирование отменено.\n\nВыберите действие:"
 
@@ -237,17 +230,10 @@ TEMPLATE_CONFIRM = """
 Создать изображение по этому шаблону?
 """
 
-TEMPLATE_TASK_CREATED = """
-✅ <b>Задача создана!</b>
-
-🆔 ID задачи: <code>{task_id}</code>
-📝 Шаблон: {template_name}
-
-⏳ Ваше изображение генерируется...
-Я отправлю результат, когда будет готово.
-
-Это может занять 10-30 секунд.
-"""
+TEMPLATE_TASK_CREATED = _TASK_CREATED.format(
+    details="📝 Шаблон: {template_name}\n",
+    action="генерируется",
+)
 
 TEMPLATE_CANCELLED = """
 💡 <b>Идеи и тренды</b>
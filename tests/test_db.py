@@ -1,11 +1,14 @@
 """Tests for database models and repositories."""
 
+from datetime import datetime, timedelta, timezone
+
 import pytest
 import pytest_asyncio
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from bot.db.models import User, GenerationTask, Template
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.db.repositories import UserRepository, TaskRepository, StatsRepository
 from bot.config import config
 from bot.services.image_tokens import estimate_image_tokens
 
@@ -106,6 +109,57 @@ class TestUserRepository:
         updated_user = await repo.update_tokens(user.id, -5)
         assert updated_user.tokens == initial_tokens - 5
 
+    @pytest.mark.asyncio
+    async def test_update_image_settings_partial(self, test_session: AsyncSession):
+        """Test that only provided image settings are updated."""
+        repo = UserRepository(test_session)
+        user, _ = await repo.get_or_create(telegram_id=999000111)
+
+        updated_user = await repo.update_image_settings(user.id, image_quality="high")
+        assert updated_user.image_quality == "high"
+        assert updated_user.image_size == "1024x1024"
+
+    @pytest.mark.asyncio
+    async def test_get_settings_tuple(self, test_session: AsyncSession):
+        """Test reading generation settings as a plain row."""
+        repo = UserRepository(test_session)
+        user, _ = await repo.get_or_create(telegram_id=222333444)
+
+        settings = await repo.get_settings_tuple(222333444)
+        assert settings.id == user.id
+        assert settings.tokens == user.tokens
+        assert settings.image_quality == user.image_quality
+        assert settings.image_size == user.image_size
+        assert settings.selected_model == user.selected_model
+        assert await repo.get_settings_tuple(1) is None
+
+    @pytest.mark.asyncio
+    async def test_get_tokens(self, test_session: AsyncSession):
+        """Test reading only the token balance."""
+        repo = UserRepository(test_session)
+        user, _ = await repo.get_or_create(telegram_id=333444555)
+
+        assert await repo.get_tokens(333444555) == user.tokens
+        assert await repo.get_tokens(1) is None
+
+    @pytest.mark.asyncio
+    async def test_get_snapshot(self, test_session: AsyncSession):
+        """Test reading a user snapshot (cache disabled falls back to DB)."""
+        repo = UserRepository(test_session)
+        user, _ = await repo.get_or_create(telegram_id=222333444)
+
+        snapshot = await repo.get_snapshot(222333444)
+        assert snapshot.id == user.id
+        assert snapshot.tokens == user.tokens
+        assert snapshot.selected_model == user.selected_model
+        assert await repo.get_snapshot(1) is None
+
+    @pytest.mark.asyncio
+    async def test_update_tokens_missing_user(self, test_session: AsyncSession):
+        """Test updating tokens for a non-existent user returns None."""
+        repo = UserRepository(test_session)
+        assert await repo.update_tokens(999999, 5) is None
+
 
 class TestTaskRepository:
     """Tests for TaskRepository."""
@@ -127,6 +181,7 @@ class TestTaskRepository:
         assert task.id is not None
         assert task.status == "pending"
         assert task.task_type == "generate"
+        assert task.created_at is not None
 
     @pytest.mark.asyncio
     async def test_update_status(self, test_session: AsyncSession):
@@ -151,6 +206,118 @@ class TestTaskRepository:
         assert updated.status == "done"
         assert updated.result_image_url == "https://example.com/image.png"
 
+    @pytest.mark.asyncio
+    async def test_update_status_increment_retry(self, test_session: AsyncSession):
+        """Test retry counter is incremented in the same update."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=654654654)
+        task = await task_repo.create(
+            user_id=user.id,
+            task_type="generate",
+            prompt="Retry prompt",
+            tokens_spent=1,
+        )
+
+        updated = await task_repo.update_status(
+            task_id=task.id,
+            status="pending",
+            error_message="timeout",
+            increment_retry=True,
+        )
+
+        assert updated.retry_count == 1
+        assert updated.error_message == "timeout"
+        assert await task_repo.update_status(task_id=999999, status="done") is None
+
+    @pytest.mark.asyncio
+    async def test_start_processing(self, test_session: AsyncSession):
+        """Test processing transition returns the task and owner's Telegram ID."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=852852852)
+        task = await task_repo.create(
+            user_id=user.id,
+            task_type="generate",
+            prompt="Processing prompt",
+            tokens_spent=1,
+        )
+
+        started, telegram_id = await task_repo.start_processing(task.id)
+        assert started.id == task.id
+        assert started.status == "processing"
+        assert telegram_id == 852852852
+        assert await task_repo.start_processing(999999) is None
+        # Already claimed by another job
+        assert await task_repo.start_processing(task.id) is None
+        assert await task_repo.update_status(
+            task.id, "done", expected_status="pending"
+        ) is None
+
+    @pytest.mark.asyncio
+    async def test_record_failure(self, test_session: AsyncSession):
+        """Test failed attempts go back to pending until retries run out."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=741741741)
+        task = await task_repo.create(
+            user_id=user.id,
+            task_type="generate",
+            prompt="Failing prompt",
+            tokens_spent=1,
+        )
+        await task_repo.update_status(task.id, status="processing")
+
+        first, telegram_id = await task_repo.record_failure(task.id, "timeout", max_retries=2)
+        assert telegram_id == 741741741
+        assert first.status == "pending"
+        assert first.retry_count == 1
+        # Not processing: nothing to record
+        assert await task_repo.record_failure(task.id, "x", max_retries=2) is None
+
+        await task_repo.start_processing(task.id)
+
+        second, _ = await task_repo.record_failure(task.id, "rate limit", max_retries=2)
+        assert second.status == "failed"
+        assert second.retry_count == 2
+        assert second.error_message == "rate limit"
+        assert await task_repo.record_failure(999999, "x", max_retries=2) is None
+
+    @pytest.mark.asyncio
+    async def test_count_by_status(self, test_session: AsyncSession):
+        """Test per-status task counts for a user."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=258258258)
+        tasks = await task_repo.create_many([
+            {"user_id": user.id, "task_type": "generate", "prompt": "p", "tokens_spent": 1}
+            for _ in range(3)
+        ])
+        await task_repo.update_status(tasks[0].id, "done")
+
+        counts = await task_repo.count_by_status(user.id)
+        assert counts == {"done": 1, "pending": 2}
+
+    @pytest.mark.asyncio
+    async def test_create_many(self, test_session: AsyncSession):
+        """Test creating several tasks in one batch."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=789789789)
+        tasks = await task_repo.create_many([
+            {"user_id": user.id, "task_type": "generate", "prompt": f"Batch {i}", "tokens_spent": 1}
+            for i in range(3)
+        ])
+
+        assert [t.prompt for t in tasks] == ["Batch 0", "Batch 1", "Batch 2"]
+        assert all(t.id is not None and t.status == "pending" for t in tasks)
+        assert tasks[0].model == "gpt-image-1"
+
     @pytest.mark.asyncio
     async def test_get_user_history(self, test_session: AsyncSession):
         """Test getting user's generation history."""
@@ -170,3 +337,121 @@ class TestTaskRepository:
 
         history = await task_repo.get_user_history(user.id, limit=3)
         assert len(history) == 3
+
+    @pytest.mark.asyncio
+    async def test_get_user_history_page(self, test_session: AsyncSession):
+        """Test paged history returns the task counts alongside the page."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=147147147)
+        for i in range(5):
+            await task_repo.create(
+                user_id=user.id,
+                task_type="generate",
+                prompt=f"Prompt {i}",
+                tokens_spent=1,
+            )
+
+        tasks = await task_repo.get_user_history(user.id)
+        await task_repo.update_status(tasks[0].id, status="done")
+
+        page = await task_repo.get_user_history_page(user.id, limit=2, offset=4)
+        assert len(page.tasks) == 1
+        assert page.total == 5
+        assert page.done == 1
+
+        page = await task_repo.get_user_history_page(user.id + 1, limit=2)
+        assert page.tasks == []
+        assert page.total == 0
+        assert page.done == 0
+
+    @pytest.mark.asyncio
+    async def test_count_user_tasks_since(self, test_session: AsyncSession):
+        """Test only tasks inside the look-back window are counted."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=258258258)
+        await task_repo.create(
+            user_id=user.id, task_type="generate", prompt="p", tokens_spent=1
+        )
+        old = await task_repo.create(
+            user_id=user.id, task_type="generate", prompt="p", tokens_spent=1
+        )
+        await test_session.execute(
+            update(GenerationTask)
+            .where(GenerationTask.id == old.id)
+            .values(created_at=datetime.now(timezone.utc) - timedelta(hours=3))
+        )
+        await test_session.commit()
+
+        assert await task_repo.count_user_tasks_since(user.id, hours=1) == 1
+        assert await task_repo.count_user_tasks_since(user.id, hours=4) == 2
+
+
+class TestStatsRepository:
+    """Tests for StatsRepository."""
+
+    @pytest.mark.asyncio
+    async def test_get_top_users(self, test_session: AsyncSession):
+        """Test top users are ordered by task count."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        light, _ = await user_repo.get_or_create(telegram_id=1001, username="light")
+        heavy, _ = await user_repo.get_or_create(telegram_id=1002, username="heavy")
+
+        await task_repo.create(
+            user_id=light.id, task_type="generate", prompt="p", tokens_spent=1
+        )
+        for _ in range(3):
+            await task_repo.create(
+                user_id=heavy.id, task_type="generate", prompt="p", tokens_spent=1
+            )
+
+        top_users = await StatsRepository(test_session).get_top_users(limit=10)
+        assert [u.username for u in top_users] == ["heavy", "light"]
+        assert top_users[0].task_count == 3
+        assert top_users[0].telegram_id == 1002
+
+    @pytest.mark.asyncio
+    async def test_get_model_usage(self, test_session: AsyncSession):
+        """Test model usage is grouped and ordered by count."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        user, _ = await user_repo.get_or_create(telegram_id=1003)
+        for model in ("gpt-image-1", "gpt-image-1-mini", "gpt-image-1-mini"):
+            await task_repo.create(
+                user_id=user.id, task_type="generate", prompt="p",
+                tokens_spent=1, model=model,
+            )
+
+        usage = await StatsRepository(test_session).get_model_usage()
+        assert list(usage.items()) == [("gpt-image-1-mini", 2), ("gpt-image-1", 1)]
+
+    @pytest.mark.asyncio
+    async def test_get_full_stats(self, test_session: AsyncSession):
+        """Test the single-query stats, including the JSON breakdowns."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+
+        first, _ = await user_repo.get_or_create(telegram_id=1004)
+        await user_repo.get_or_create(telegram_id=1005)
+        for model in ("gpt-image-1", "gpt-image-1-mini", "gpt-image-1-mini"):
+            task = await task_repo.create(
+                user_id=first.id, task_type="generate", prompt="p",
+                tokens_spent=2, model=model,
+            )
+        await task_repo.update_status(task.id, status="done")
+
+        stats = await StatsRepository(test_session).get_full_stats()
+        assert stats["total_users"] == 2
+        assert stats["users_today"] == 2
+        assert stats["total_tasks"] == 3
+        assert stats["tasks_today"] == 3
+        assert stats["active_users_today"] == 1
+        assert stats["total_tokens_spent"] == 6
+        assert stats["tasks_by_status"] == {"pending": 2, "done": 1}
+        assert stats["model_usage"] == {"gpt-image-1": 1, "gpt-image-1-mini": 2}
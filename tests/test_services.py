@@ -1,5 +1,7 @@
 """Tests for service layer - BalanceService and templates."""
 
+import asyncio
+
 import pytest
 import pytest_asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -15,6 +17,14 @@ from bot.templates.prompts import (
     get_template_by_id,
     get_all_templates,
 )
+from bot.services.image_provider import (
+    _get_http_client,
+    _get_openai_client,
+    close_http_client,
+)
+from bot.tasks import generation
+from bot.tasks.generation import MAX_RETRIES, _build_result_caption, _record_failed_attempt
+from bot.utils.helpers import escape_prompt_preview
 
 
 class TestBalanceService:
@@ -68,6 +78,30 @@ class TestBalanceService:
         assert exc_info.value.required == user.tokens + 1
         assert exc_info.value.available == user.tokens
 
+    @pytest.mark.asyncio
+    async def test_deduct_and_create_task(self, test_session: AsyncSession):
+        """Test charging and task creation happen together."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+        user, _ = await user_repo.get_or_create(telegram_id=100100110)
+        initial_tokens = user.tokens
+
+        balance_service = BalanceService(test_session)
+        task = await balance_service.deduct_and_create_task(
+            user.id, 7, task_type="generate", prompt="Atomic"
+        )
+
+        assert task.tokens_spent == 7
+        assert task.status == "pending"
+        refreshed = await user_repo.get_by_telegram_id(100100110)
+        assert refreshed.tokens == initial_tokens - 7
+
+        with pytest.raises(InsufficientBalanceError):
+            await balance_service.deduct_and_create_task(
+                user.id, initial_tokens, task_type="generate", prompt="Too much"
+            )
+        assert len(await task_repo.get_user_history(user.id)) == 1
+
     @pytest.mark.asyncio
     async def test_refund_tokens(self, test_session: AsyncSession):
         """Test refunding tokens to user."""
@@ -150,3 +184,108 @@ class TestPromptTemplates:
         """Test that all template IDs are unique."""
         ids = [t.id for t in TEMPLATES]
         assert len(ids) == len(set(ids))
+
+
+class TestPromptPreview:
+    """Tests for prompt previews shown in HTML messages."""
+
+    def test_escapes_html(self):
+        """Test user text can't break the message markup."""
+        assert escape_prompt_preview("a < b & <i>c</i>") == "a &lt; b &amp; &lt;i&gt;c&lt;/i&gt;"
+
+    def test_truncates_before_escaping(self):
+        """Test the limit applies to the prompt, not the escaped text."""
+        assert escape_prompt_preview("<" * 10, max_length=3) == "&lt;&lt;&lt;..."
+        assert escape_prompt_preview("short", max_length=5) == "short"
+
+    def test_result_caption_escapes_prompt(self):
+        """Test the worker's result caption is valid HTML for any prompt."""
+        task = GenerationTask(
+            id=1,
+            user_id=1,
+            task_type="generate",
+            prompt="a cat <3 & a dog",
+            image_quality="medium",
+            image_size="1024x1024",
+            tokens_spent=2,
+        )
+
+        caption = _build_result_caption(task)
+
+        assert "Промпт: a cat &lt;3 &amp; a dog" in caption
+        assert "<3" not in caption
+
+
+class TestHttpClients:
+    """Tests for the provider's shared HTTP clients."""
+
+    @pytest.mark.asyncio
+    async def test_openai_client_shared_and_configured(self):
+        """Test one OpenAI client per key, built with the configured timeouts."""
+        client = _get_openai_client("test-key")
+
+        assert _get_openai_client("test-key") is client
+        assert client.timeout.read == config.openai_timeout_seconds
+        # RQ retries the task; the SDK must not retry on its own
+        assert client.max_retries == 0
+        await close_http_client()
+
+    @pytest.mark.asyncio
+    async def test_close_http_client_closes_all_pools(self):
+        """Test shutdown closes the download client and the OpenAI clients."""
+        download = _get_http_client()
+        openai_client = _get_openai_client("test-key")
+
+        await close_http_client()
+
+        assert download.is_closed
+        assert openai_client.is_closed()
+        # Recreated on next use
+        assert _get_http_client() is not download
+        assert _get_openai_client("test-key") is not openai_client
+        await close_http_client()
+
+
+class TestGenerationFailures:
+    """Tests for settling failed generation attempts."""
+
+    @pytest.mark.asyncio
+    async def test_last_attempt_refunds_once(self, test_session: AsyncSession):
+        """Test only the final attempt refunds, and a settled task is left alone."""
+        user_repo = UserRepository(test_session)
+        task_repo = TaskRepository(test_session)
+        user, _ = await user_repo.get_or_create(telegram_id=369369369)
+        initial_tokens = user.tokens
+
+        task = await BalanceService(test_session).deduct_and_create_task(
+            user.id, 5, task_type="generate", prompt="Doomed"
+        )
+
+        for _ in range(MAX_RETRIES):
+            await task_repo.start_processing(task.id)
+            settled = await _record_failed_attempt(test_session, task.id, "boom")
+
+        assert settled.status == "failed"
+        refreshed = await user_repo.get_by_telegram_id(369369369)
+        assert refreshed.tokens == initial_tokens
+
+        # e.g. the RQ failure callback after the job already recorded it
+        assert await _record_failed_attempt(test_session, task.id, "boom") is None
+        refreshed = await user_repo.get_by_telegram_id(369369369)
+        assert refreshed.tokens == initial_tokens
+
+    def test_job_loop_closed_after_each_job(self):
+        """Test each job gets its own loop, closed even when the job fails."""
+        async def ok():
+            return asyncio.get_running_loop()
+
+        async def boom():
+            raise RuntimeError("boom")
+
+        loop = generation._run_job(ok())
+        assert loop.is_closed()
+        assert generation._loop is None
+
+        with pytest.raises(RuntimeError):
+            generation._run_job(boom())
+        assert generation._loop is None
@@ -12,10 +12,10 @@ import argparse
 import logging
 import sys
 
-from redis import Redis
 from rq import Worker, Queue
 
 from bot.config import config
+from bot.tasks.generation import get_redis_connection
 
 # Configure logging
 logging.basicConfig(
@@ -42,19 +42,21 @@ def main():
     )
     args = parser.parse_args()
     
-    # Connect to Redis
-    redis_conn = Redis.from_url(config.redis_url)
+    # Connect to Redis through the same pool the queue uses
+    redis_conn = get_redis_connection()
     logger.info(f"Connected to Redis at {config.redis_url}")
     
     # Create queue
     queue = Queue(name=args.queue, connection=redis_conn)
     logger.info(f"Listening on queue: {args.queue}")
     
-    # Start worker
+    # Start worker. Each job runs in a forked work horse, so a crash or a
+    # hard kill on timeout only takes down that job.
     worker = Worker([queue], connection=redis_conn)
     
     logger.info("Starting RQ worker...")
-    worker.work(burst=args.burst)
+    # The scheduler moves delayed retries back onto the queue
+    worker.work(burst=args.burst, with_scheduler=True)
 
 
 if __name__ == "__main__":